@@ -4,90 +4,377 @@
 # -----------------------------------------------------------
 
 
+import heapq
 import numpy as np
-from mdp import MDP
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+from scipy.signal import lfilter
+from scipy.sparse.linalg import spsolve
+from mdp import MDP, gather_segments
+from SSPP import prob1
+from instrumentation import Stats, stage, record
 
-start: object
-end: object
-mdp: MDP
 
+def _residual(new_values, values):
+    # equal infinite values (states without actions, diverging costs) count as converged
+    return np.max(np.where(new_values == values, 0., np.abs(new_values - values)), initial=0.)
 
-def step(state, action):
-    observation = np.random.choice(list(mdp.get_actions(state)[action]),
-                                   p=list(mdp.get_actions(state)[action].values()))
-    reward = mdp.get_weight(state, action, observation)
-    done = (observation == end)
-    return observation, reward, done
 
+def _state_backup(lists, s, values, gamma):
+    action_ptr, succ_ptr, succ, proba, weight = lists
+    best = -np.inf
+    for r in range(action_ptr[s], action_ptr[s + 1]):
+        v_temp = 0.
+        for j in range(succ_ptr[r], succ_ptr[r + 1]):
+            v_temp += proba[j] * (weight[j] + gamma * values[succ[j]])
+        if v_temp > best:
+            best = v_temp
+    return best
 
-def generate_action(state, policy, epsilon):
-    if np.random.rand() > epsilon:
-        action = policy[state]
-    else:
-        action = np.random.choice(list(mdp.get_actions(state)))
-    return action
+
+def _gauss_seidel(compiled, values, gamma, episodes, tol, report):
+    """
+    In-place sweeps over the states: every backup reads the values already updated in the sweep
+    """
+    lists = (compiled.action_ptr.tolist(), compiled.succ_ptr.tolist(), compiled.succ.tolist(),
+             compiled.proba.tolist(), compiled.weight.tolist())
+    values = values.tolist()
+    for k in range(episodes):
+        residual = 0.
+        for s in range(compiled.n_states):
+            new_value = _state_backup(lists, s, values, gamma)
+            if new_value != values[s]:
+                residual = max(residual, abs(new_value - values[s]))
+                values[s] = new_value
+        report(k, residual)
+        if residual <= tol:
+            break
+    return np.array(values)
+
+
+def _prioritized_sweeping(compiled, values, gamma, episodes, tol, report):
+    """
+    Back up the state with the largest Bellman error first, then re-prioritize its predecessors;
+    One "sweep" is counted every n_states backups and reports the largest change of its backups;
+    The last (possibly partial) sweep reports the Bellman error left over all the states
+    """
+    lists = (compiled.action_ptr.tolist(), compiled.succ_ptr.tolist(), compiled.succ.tolist(),
+             compiled.proba.tolist(), compiled.weight.tolist())
+    pred_ptr, pred_trans = compiled.predecessors()
+    pred_ptr = pred_ptr.tolist()
+    pred_state = compiled.row_state[compiled.trans_row[pred_trans]].tolist()
+
+    def backup_all(values):
+        return compiled.state_max(compiled.row_sum(compiled.proba * (compiled.weight + gamma * values[compiled.succ])))
+
+    new_values = backup_all(values)
+    errors = np.where(new_values == values, 0., np.abs(new_values - values))
+    priority = errors.tolist()
+    values = values.tolist()
+    heap = [(-e, s) for s, e in enumerate(priority) if e > tol]
+    heapq.heapify(heap)
+
+    def drop_stale():
+        while heap and -heap[0][0] != priority[heap[0][1]]:
+            heapq.heappop(heap)
+
+    budget = episodes * compiled.n_states
+    updates = 0
+    residual = 0.
+    drop_stale()
+    while heap and updates < budget:
+        _, s = heapq.heappop(heap)
+        new_value = _state_backup(lists, s, values, gamma)
+        if new_value != values[s]:
+            residual = max(residual, abs(new_value - values[s]))
+            values[s] = new_value
+        priority[s] = 0.
+        for p in set(pred_state[pred_ptr[s]:pred_ptr[s + 1]]):
+            new_value = _state_backup(lists, p, values, gamma)
+            error = 0. if new_value == values[p] else abs(new_value - values[p])
+            if error > tol and error != priority[p]:
+                priority[p] = error
+                heapq.heappush(heap, (-error, p))
+        updates += 1
+        drop_stale()
+        if updates % compiled.n_states == 0 and heap and updates < budget:
+            report(updates // compiled.n_states - 1, residual)
+            residual = 0.
+    values = np.array(values)
+    report(max(-(-updates // compiled.n_states) - 1, 0), _residual(backup_all(values), values))
+    return values
 
 
 def vi(markov: MDP,
-       initial_state,
-       terminal_state,
+       initial_state=None,
+       terminal_state=None,
        gamma: float = 1.,
        episodes: int = 50,
+       tol: float = 1e-6,
+       sweep: str = 'jacobi',
+       verbose: int = 0,  # Integer. 0 or 1. Verbosity mode
+       callback=None,
+       stats: Stats = None
        ):
     """
     value iteration
     :param markov: Markov Decision Process instance
-    :param initial_state: initial point
-    :param terminal_state: terminal point
+    :param initial_state: initial point (unused, kept for the agents' common signature)
+    :param terminal_state: terminal point (unused, kept for the agents' common signature)
     :param gamma: discount factor
-    :param episodes: runs of iterations
+    :param episodes: maximum number of sweeps
+    :param tol: stop as soon as a sweep changes no value by more than tol
+    :param sweep: 'jacobi' (vectorized synchronous backups), 'gauss-seidel' (in-place backups)
+        or 'prioritized' (prioritized sweeping)
+    :param verbose: print the residual of every sweep
+    :param callback: function called with (sweep, residual) after every sweep
+    :param stats: Stats receiving the 'sweeps' timing and counter and the 'residual' series
     :return: values, policy
     """
-    global start
-    global end
-    global mdp
+    compiled = markov.compile()
 
-    start = initial_state
-    end = terminal_state
-    mdp = markov
+    def bellman_op(values):
+        # expected reward + discounted value of every action row, maximised over the actions of each state
+        q = compiled.row_sum(compiled.proba * (compiled.weight + gamma * values[compiled.succ]))
+        return compiled.state_max(q), compiled.state_argmax(q)
+
+    sweeps = [0]
+
+    def report(k, residual):
+        sweeps[0] = k + 1
+        if verbose > 0:
+            print("Sweep {}: residual {}".format(k + 1, residual))
+        if callback is not None:
+            callback(k, residual)
+        if stats is not None:
+            stats.append('residual', residual)
+
+    values = np.zeros(compiled.n_states)
+    with stage(stats, 'sweeps'):
+        if sweep == 'jacobi':
+            for k in range(episodes):
+                new_values, _ = bellman_op(values)
+                residual = _residual(new_values, values)
+                values = new_values
+                report(k, residual)
+                if residual <= tol:
+                    break
+        elif sweep == 'gauss-seidel':
+            values = _gauss_seidel(compiled, values, gamma, episodes, tol, report)
+        elif sweep == 'prioritized':
+            values = _prioritized_sweeping(compiled, values, gamma, episodes, tol, report)
+        else:
+            raise ValueError("unknown sweep: {}".format(sweep))
+    record(stats, 'sweeps', sweeps[0])
+
+    # greedy policy with respect to the final values
+    _, best_rows = bellman_op(values)
+    v = compiled.to_dict(values)
+    pi = {state: compiled.actions[row] for state, row in zip(compiled.states, best_rows) if row >= 0}
 
-    v = {}
-    for k in mdp.get_states():
-        v[k] = 0
+    return v, pi
 
-    pi = {}
-    for k in mdp.get_states():
-        pi[k] = np.random.choice(list(mdp.get_actions(k)))
 
-    count = {}
-    for k in mdp.get_states():
-        count[k] = {}
-        for kk in mdp.get_actions(k):
-            count[k][kk] = 0
+def _evaluate_policy(compiled, rows, gamma):
+    """
+    Exact values of the stationary policy choosing action row rows[s] in every state s (-1: no action),
+    by a sparse linear solve on the induced Markov chain;
+    Weights are assumed non-positive: states that may end up in a recurrent class collecting
+    non-zero rewards (only possible when gamma == 1) or in a state without actions get -inf
+    """
+    n = compiled.n_states
+    acting = np.flatnonzero(rows >= 0)
+    transitions = gather_segments(compiled.succ_ptr, rows[acting])
+    lens = np.diff(compiled.succ_ptr)[rows[acting]]
+    fr = np.repeat(acting, lens)
+    to = compiled.succ[transitions]
+    chain = sp.csr_matrix((compiled.proba[transitions], (fr, to)), shape=(n, n))
+    reward = np.zeros(n)
+    reward[acting] = compiled.row_sum(compiled.proba * compiled.weight)[rows[acting]]
+
+    bad = rows < 0
+    free = np.zeros(n, dtype=bool)
+    if gamma == 1.:
+        # recurrent classes: zero-reward ones have value 0, the other ones diverge
+        n_components, labels = connected_components(chain, directed=True, connection='strong')
+        leaving = np.bincount(labels[fr[labels[fr] != labels[to]]], minlength=n_components) > 0
+        costly = np.bincount(labels, weights=np.abs(reward), minlength=n_components) > 0
+        recurrent = ~leaving[labels] & ~bad
+        free = recurrent & ~costly[labels]
+        bad |= recurrent & costly[labels]
+    if bad.any():
+        # every state that can reach a bad state is bad
+        source = sp.csr_matrix((np.ones(bad.sum()), (np.full(bad.sum(), n), np.flatnonzero(bad))),
+                               shape=(n + 1, n + 1))
+        reverse = sp.bmat([[chain.T, None], [None, sp.csr_matrix((1, 1))]]).tocsr() + source
+        bad[breadth_first_order(reverse, n, directed=True, return_predecessors=False)[1:]] = True
+
+    values = np.zeros(n)
+    values[bad] = -np.inf
+    solved = ~bad & ~free
+    if solved.any():
+        system = sp.identity(solved.sum(), format='csr') - gamma * chain[solved][:, solved]
+        values[solved] = spsolve(system.tocsc(), reward[solved])
+    return values
+
+
+def _proper_rows(compiled, kept, terminal):
+    """
+    Initial policy reaching "terminal" with probability 1 from every state of boolean array "kept"
+    (the states where this is possible): built backward from "terminal", every newly reached state
+    picks an action staying in "kept" with a successor already reached; other states take their first action
+    """
+    rows = np.where(np.diff(compiled.action_ptr) > 0, compiled.action_ptr[:-1], -1)
+    closed = compiled.row_sum(kept[compiled.succ].astype(float)) == np.diff(compiled.succ_ptr)
+    pred_ptr, pred_trans = compiled.predecessors()
+    reached = np.zeros(compiled.n_states, dtype=bool)
+    reached[terminal] = True
+    frontier = np.array([terminal])
+    while frontier.size:
+        transitions = pred_trans[gather_segments(pred_ptr, frontier)]
+        candidates = compiled.trans_row[transitions]
+        candidates = candidates[closed[candidates] & ~reached[compiled.row_state[candidates]]]
+        owners, first = np.unique(compiled.row_state[candidates], return_index=True)
+        rows[owners] = candidates[first]
+        reached[owners] = True
+        frontier = owners
+    return rows
+
+
+def policy_iteration(markov: MDP,
+                     initial_state,
+                     terminal_state,
+                     gamma: float = 1.,
+                     episodes: int = 50,
+                     ):
+    """
+    policy iteration
+    :param markov: Markov Decision Process instance
+    :param initial_state: initial point
+    :param terminal_state: terminal point
+    :param gamma: discount factor
+    :param episodes: maximum number of policy improvements
+    :return: values, policy
+    """
+    compiled = markov.compile()
+    # start from a proper policy (reaching the terminal state surely) wherever one exists
+    rows = _proper_rows(compiled, prob1(markov, [terminal_state]), compiled.index[terminal_state])
+    acting = rows >= 0
+    for k in range(episodes):
+        values = _evaluate_policy(compiled, rows, gamma)
+        q = compiled.row_sum(compiled.proba * (compiled.weight + gamma * values[compiled.succ]))
+        best = compiled.state_max(q)
+        # switch action only on a strict improvement, so that the iteration terminates
+        current = np.where(acting, q[np.maximum(rows, 0)], -np.inf)
+        slack = 1e-12 * np.maximum(1., np.abs(np.where(np.isfinite(current), current, 0.)))
+        improved = acting & (best > current + slack)
+        if not improved.any():
+            break
+        rows = np.where(improved, compiled.state_argmax(q), rows)
+    values = _evaluate_policy(compiled, rows, gamma)
+
+    v = compiled.to_dict(values)
+    pi = {state: compiled.actions[row] for state, row in zip(compiled.states, rows) if row >= 0}
+    return v, pi
 
-    def bellman_op(values):
-        v0 = {}
-        pi0 = {}
-        for i in mdp.get_states():
-            pi0[i] = np.random.choice(list(mdp.get_actions(i)))
-            v0[i] = -np.inf
-
-        for state in mdp.get_states():
-            for action in mdp.get_actions(state):
-                v_temp = 0.
-                for next_state in mdp.get_actions(state)[action]:
-                    probability = mdp.get_actions(state)[action][next_state]
-                    reward = mdp.get_weight(state, action)
-                    v_temp += (probability * (reward + gamma * values[next_state]))
-                if v_temp > v0[state]:
-                    v0[state] = v_temp
-                    pi0[state] = action
-        return v0, pi0
 
-    for k in range(episodes):
-        v, pi = bellman_op(v)
+def _segment_best(compiled, q, states):
+    """
+    Maximum of the per-row array "q" over the actions of every state of "states" and its first maximising row;
+    (0, -1) for the states without actions
+    """
+    lens = compiled.action_ptr[states + 1] - compiled.action_ptr[states]
+    best = np.zeros(len(states))
+    rows = np.full(len(states), -1, dtype=np.int64)
+    has_actions = lens > 0
+    if has_actions.any():
+        segments = gather_segments(compiled.action_ptr, states[has_actions])
+        starts = np.cumsum(lens[has_actions]) - lens[has_actions]
+        best[has_actions] = np.maximum.reduceat(q[segments], starts)
+        candidates = np.where(q[segments] >= np.repeat(best[has_actions], lens[has_actions]), segments, compiled.n_rows)
+        rows[has_actions] = np.minimum.reduceat(candidates, starts)
+    return best, rows
+
+
+def _run_episodes(compiled, start, end, greedy, update, finish,
+                  episodes, envs, max_steps, epsilon, eps_min, eps_decade, rng, verbose):
+    """
+    Run "episodes" epsilon-greedy episodes of the per-state action rows "greedy" (updated by the callers)
+    from "start" to "end" on "envs" environments stepped as a batch;
+    update(ids, states, rows, transitions, steps) is called after every batch step with the running environments,
+    finish(ids, steps) with the environments whose episode just ended, before they restart;
+    An episode also ends after "max_steps" steps or in a state without action;
+    Return the numbers of finished episodes, environment steps and batch steps
+    """
+    envs = max(min(envs, episodes), 1)
+    finished = env_steps = batch_steps = 0
+    state = np.full(envs, start, dtype=np.int64)
+    steps = np.zeros(envs, dtype=np.int64)
+    total_reward = np.zeros(envs)
+    running = np.arange(envs)
+    started = envs
+    n_actions = np.diff(compiled.action_ptr)
+    while len(running):
+        s = state[running]
+        rows = greedy[s]
+        explore = rng.random(len(s)) <= epsilon
+        rows[explore] = (compiled.action_ptr[s[explore]] +
+                         (rng.random(explore.sum()) * n_actions[s[explore]]).astype(np.int64))
+        acting = n_actions[s] > 0
+        ids, s, rows = running[acting], s[acting], rows[acting]
+        transitions = compiled.sample(rows, rng)
+        update(ids, s, rows, transitions, steps[ids])
+        if verbose > 1:
+            for i, row, j in zip(s, rows, transitions):
+                print("{}-{}-{},".format(compiled.states[i], compiled.actions[row], compiled.states[compiled.succ[j]]),
+                      end=' ')
+            print()
+        state[ids] = compiled.succ[transitions]
+        total_reward[ids] += compiled.weight[transitions]
+        steps[ids] += 1
+        env_steps += len(ids)
+        batch_steps += 1
+
+        done = ~acting
+        done[acting] = (state[ids] == end) | (steps[ids] >= max_steps)
+        ended = running[done]
+        if len(ended):
+            finish(ended, steps[ended])
+            finished += len(ended)
+            if verbose > 0:
+                for e in ended:
+                    print("\nEpisode finished after {} timesteps with reward {}".format(steps[e], total_reward[e]))
+            epsilon = max(eps_min, epsilon * eps_decade ** len(ended))
+            restart = ended[:max(min(len(ended), episodes - started), 0)]
+            started += len(restart)
+            state[restart], steps[restart], total_reward[restart] = start, 0, 0.
+            running = np.concatenate((running[~done], restart))
+    return finished, env_steps, batch_steps
+
+
+def _record_episodes(stats, counts):
+    for name, value in zip(('episodes', 'env_steps', 'batch_steps'), counts):
+        record(stats, name, value)
+
+
+def _learned_tables(compiled, q, greedy):
+    """
+    Convert the per-row array "q" and the per-state rows "greedy" into {state: {action: q}} and {state: action}
+    """
+    q_table = {state: {compiled.actions[row]: float(q[row])
+                       for row in range(compiled.action_ptr[i], compiled.action_ptr[i + 1])}
+               for i, state in enumerate(compiled.states)}
+    pi = {state: compiled.actions[row] for state, row in zip(compiled.states, greedy) if row >= 0}
+    return q_table, pi
 
-    return v, pi
+
+def _initial_rows(compiled, rng):
+    """
+    Uniformly random action row of every state (-1 for the states without actions)
+    """
+    n_actions = np.diff(compiled.action_ptr)
+    return np.where(n_actions > 0,
+                    compiled.action_ptr[:-1] + (rng.random(compiled.n_states) * n_actions).astype(np.int64), -1)
 
 
 def q_learn(markov: MDP,
@@ -99,54 +386,36 @@ def q_learn(markov: MDP,
             eps_min=0.1,
             eps_decade=0.9,
             episodes=50,
-            verbose=1  # Integer. 0, 1, or 2. Verbosity mode
+            verbose=1,  # Integer. 0, 1, or 2. Verbosity mode
+            envs=32,  # Integer. Number of environments stepped as a batch
+            max_steps=1000,  # Integer. Maximum length of an episode
+            seed=None,  # Integer. Seed of the random generator
+            stats: Stats = None  # Stats. 'learning' timing, episode and step counts (see instrumentation.py)
             ):
-    global start
-    global end
-    global mdp
-
-    start = initial_state
-    end = terminal_state
-    mdp = markov
-
-    q = {}
-    for k in mdp.get_states():
-        q[k] = {}
-        for kk in mdp.get_actions(k):
-            q[k][kk] = 0
-
-    pi = {}
-    for k in mdp.get_states():
-        pi[k] = np.random.choice(list(mdp.get_actions(k)))
-
-    count = {}
-    for k in mdp.get_states():
-        count[k] = {}
-        for kk in mdp.get_actions(k):
-            count[k][kk] = 0
-
-    for e in range(episodes):
-        state = start
-        total_reward = 0
-        for t in range(1000):
-            action = generate_action(state, pi, epsilon)
-            next_state, reward, done = step(state, action)
-            count[state][action] += 1
-            total_reward += reward
-            q[state][action] += alpha * (reward + gamma * max(q[next_state].values()) - q[state][action])
-            pi[state] = max(q[state], key=q[state].get)
-            if verbose > 1:
-                if (t + 1) % 10 == 0:
-                    print("\n{}-{}-{},".format(state, action, next_state), end=' ')
-                else:
-                    print("{}-{}-{},".format(state, action, next_state), end=' ')
-            state = next_state
-            if done:
-                if verbose > 0:
-                    print("\nEpisode finished after {} timesteps with reward {}".format(t + 1, total_reward))
-                break
-        epsilon = max(eps_min, epsilon * eps_decade)
-    return q, pi
+    """
+    Q-learning with an array Q table over the compiled action rows;
+    The "envs" environments are stepped together: their updates of a batch step are computed from the same
+    Q table and summed; no module state is used, so concurrent calls are safe
+    :return: q {state: {action: value}}, greedy policy {state: action}
+    """
+    compiled = markov.compile()
+    rng = np.random.default_rng(seed)
+    q = np.zeros(compiled.n_rows)
+    greedy = _initial_rows(compiled, rng)
+
+    def update(ids, states, rows, transitions, steps):
+        best_next, _ = _segment_best(compiled, q, compiled.succ[transitions])
+        target = compiled.weight[transitions] + gamma * best_next
+        np.add.at(q, rows, alpha * (target - q[rows]))
+        updated = np.unique(states)
+        greedy[updated] = _segment_best(compiled, q, updated)[1]
+
+    with stage(stats, 'learning'):
+        counts = _run_episodes(compiled, compiled.index[initial_state], compiled.index[terminal_state], greedy,
+                               update, lambda ids, steps: None,
+                               episodes, envs, max_steps, epsilon, eps_min, eps_decade, rng, verbose)
+    _record_episodes(stats, counts)
+    return _learned_tables(compiled, q, greedy)
 
 
 def monte_carlo(markov: MDP,
@@ -157,59 +426,50 @@ def monte_carlo(markov: MDP,
                 eps_min=0.1,
                 eps_decade=0.9,
                 episodes=50,
-                verbose=1  # Integer. 0, 1, or 2. Verbosity mode
+                verbose=1,  # Integer. 0, 1, or 2. Verbosity mode
+                envs=32,  # Integer. Number of environments stepped as a batch
+                max_steps=1000,  # Integer. Maximum length of an episode
+                seed=None,  # Integer. Seed of the random generator
+                stats: Stats = None  # Stats. 'learning' timing, episode and step counts (see instrumentation.py)
                 ):
-    global start
-    global end
-    global mdp
-
-    start = initial_state
-    end = terminal_state
-    mdp = markov
-
-    q = {}
-    for k in mdp.get_states():
-        q[k] = {}
-        for kk in mdp.get_actions(k):
-            q[k][kk] = 0
-
-    pi = {}
-    for k in mdp.get_states():
-        pi[k] = np.random.choice(list(mdp.get_actions(k)))
-
-    count = {}
-    for k in mdp.get_states():
-        count[k] = {}
-        for kk in mdp.get_actions(k):
-            count[k][kk] = 0
-
-    for e in range(episodes):
-        state = start
-        total_reward = 0
-        trajectory = []
-        for t in range(1000):
-            action = generate_action(state, pi, epsilon)
-            next_state, reward, done = step(state, action)
-            total_reward += reward
-            trajectory.append([state, action, reward])
-            count[state][action] += 1
-            if verbose > 1:
-                if (t + 1) % 10 == 0:
-                    print("\n{}-{}-{},".format(state, action, next_state), end=' ')
-                else:
-                    print("{}-{}-{},".format(state, action, next_state), end=' ')
-            state = next_state
-            if done:
-                if verbose > 0:
-                    print("\nEpisode finished after {} timesteps with reward {}".format(t + 1, total_reward))
-                break
-        g = 0
-        state_list, action_list, reward_list = list(zip(*trajectory))
-        for tt in reversed(range(t + 1)):
-            g = gamma * g + reward_list[tt]
-            q[state_list[tt]][action_list[tt]] += ((g - q[state_list[tt]][action_list[tt]]) /
-                                                   count[state_list[tt]][action_list[tt]])
-            pi[state_list[tt]] = max(q[state_list[tt]], key=q[state_list[tt]].get)
-
-        epsilon = max(eps_min, epsilon * eps_decade)
-    return q, pi
+    """
+    Every-visit Monte-Carlo control: q is the average return of every visited action row;
+    The trajectories of the "envs" environments are recorded in (max_steps, envs) arrays and their discounted
+    returns computed when their episode ends; no module state is used, so concurrent calls are safe
+    :return: q {state: {action: value}}, greedy policy {state: action}
+    """
+    compiled = markov.compile()
+    rng = np.random.default_rng(seed)
+    q = np.zeros(compiled.n_rows)
+    count = np.zeros(compiled.n_rows)
+    returns = np.zeros(compiled.n_rows)
+    greedy = _initial_rows(compiled, rng)
+    envs = max(min(envs, episodes), 1)
+    trajectory_rows = np.zeros((max_steps, envs), dtype=np.int64)
+    trajectory_rewards = np.zeros((max_steps, envs))
+
+    def update(ids, states, rows, transitions, steps):
+        trajectory_rows[steps, ids] = rows
+        trajectory_rewards[steps, ids] = compiled.weight[transitions]
+
+    def finish(ids, steps):
+        horizon = steps.max()
+        if not horizon:
+            return
+        valid = np.arange(horizon)[:, None] < steps[None, :]
+        rewards = np.where(valid, trajectory_rewards[:horizon, ids], 0.)
+        # discounted returns g_t = r_t + gamma * g_(t+1), computed backwards by a linear filter
+        g = lfilter([1.], [1., -gamma], rewards[::-1], axis=0)[::-1]
+        rows = trajectory_rows[:horizon, ids][valid]
+        np.add.at(count, rows, 1.)
+        np.add.at(returns, rows, g[valid])
+        visited = np.unique(rows)
+        q[visited] = returns[visited] / count[visited]
+        states = np.unique(compiled.row_state[visited])
+        greedy[states] = _segment_best(compiled, q, states)[1]
+
+    with stage(stats, 'learning'):
+        counts = _run_episodes(compiled, compiled.index[initial_state], compiled.index[terminal_state], greedy,
+                               update, finish, episodes, envs, max_steps, epsilon, eps_min, eps_decade, rng, verbose)
+    _record_episodes(stats, counts)
+    return _learned_tables(compiled, q, greedy)
@@ -13,7 +13,7 @@ pp.pprint(q)
 pp.pprint(pi)
 
 # for i in range(50):
-#     q, pi = q_learn(alpha=0.01, episodes=10000, verbose=0)
+#     q, pi = q_learn(m, start, end, alpha=0.01, episodes=10000, verbose=0)
 #     print(i, pi)
 #
 # pp.pprint(q)
@@ -4,57 +4,317 @@
 #
 # -----------------------------------------------------------
 
-from mdp import MDP, UnfoldedMDP, BOT
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import math
+from multiprocessing import shared_memory
+from mdp import MDP, UnfoldedMDP, CompiledMDP, BOT, gather_segments, normalize_weights
+from instrumentation import Stats, stage, record
+import numpy as np
 import pulp
+import scipy.sparse as sp
+from scipy.optimize import linprog
+from scipy.sparse.csgraph import connected_components
 import pprint as pp
 
 
-def reach(mdp: MDP,
+def _backward_reachable(compiled, mask, allowed=None):
+    """
+    States of "compiled" that can reach the states of boolean array "mask",
+    only using the transitions for which the boolean array "allowed" is True
+    """
+    pred_ptr, pred_trans = compiled.predecessors()
+    reached = mask.copy()
+    frontier = np.flatnonzero(mask)
+    while frontier.size:
+        transitions = pred_trans[gather_segments(pred_ptr, frontier)]
+        if allowed is not None:
+            transitions = transitions[allowed[transitions]]
+        owners = compiled.row_state[compiled.trans_row[transitions]]
+        frontier = np.unique(owners[~reached[owners]])
+        reached[frontier] = True
+    return reached
+
+
+def _target_mask(compiled, targets):
+    mask = np.zeros(compiled.n_states, dtype=bool)
+    mask[[compiled.index[t] for t in targets if t in compiled.index]] = True
+    return mask
+
+
+def prob0(mdp: MDP,
           targets: list,
-          verbose: int = 1  # Integer. 0, 1, or 2. Verbosity mode
           ):
+    """
+    Return a boolean array (indexed like "mdp.compile()") of the states from which
+    "targets" is reached with probability 0 under every strategy, i.e. cannot be reached at all
+    """
+    compiled = mdp.compile()
+    return ~_backward_reachable(compiled, _target_mask(compiled, targets))
 
-    x = {}
-    for k in mdp.get_states():
-        if k in targets:
-            x[k] = 1
-            continue
-        else:
-            x[k] = 0
-        for t in targets:
-            if mdp.connectivity(k, t) > 0:
-                x[k] = -1
-                break
 
-    # put all non-0 and non-1 states into untreated_states
-    untreated_states = list(filter(lambda s: x[s] == -1, x.keys()))
+def prob1(mdp: MDP,
+          targets: list,
+          ):
+    """
+    Return a boolean array (indexed like "mdp.compile()") of the states from which
+    "targets" is reached with probability 1 under some strategy;
+    Greatest fixpoint: keep the states that can reach "targets" using only actions
+    whose successors all stay in the kept set
+    """
+    compiled = mdp.compile()
+    is_target = _target_mask(compiled, targets)
+    kept = np.ones(compiled.n_states, dtype=bool)
+    while True:
+        # rows whose successors all stay in the kept set
+        closed_rows = compiled.row_sum(kept[compiled.succ].astype(float)) == np.diff(compiled.succ_ptr)
+        allowed = (closed_rows & kept[compiled.row_state])[compiled.trans_row]
+        reached = _backward_reachable(compiled, is_target, allowed)
+        if (reached == kept).all():
+            return kept
+        kept = reached
+
+
+def _lp_constraints(compiled, unknown, x):
+    """
+    Sparse form of the reachability constraints x[s] >= sum_ns p(s, a, ns) * x[ns]
+    of every action row of the states in boolean array "unknown", the values of the
+    other states being constants read from array "x";
+    Return (variables, A, b) with one variable per unknown state and A @ variables >= b
+    """
+    variables = np.flatnonzero(unknown)
+    var_index = np.full(compiled.n_states, -1, dtype=np.int64)
+    var_index[variables] = np.arange(len(variables))
+    rows = np.flatnonzero(unknown[compiled.row_state])
+    transitions = gather_segments(compiled.succ_ptr, rows)
+    constraint = np.repeat(np.arange(len(rows)), np.diff(compiled.succ_ptr)[rows])
+    succ = compiled.succ[transitions]
+    proba = compiled.proba[transitions]
+    inner = unknown[succ]
+    a = sp.coo_matrix((np.concatenate([np.ones(len(rows)), -proba[inner]]),
+                       (np.concatenate([np.arange(len(rows)), constraint[inner]]),
+                        np.concatenate([var_index[compiled.row_state[rows]], var_index[succ[inner]]]))),
+                      shape=(len(rows), len(variables))).tocsr()
+    b = np.bincount(constraint[~inner], weights=proba[~inner] * x[succ[~inner]], minlength=len(rows))
+    return variables, a, b
 
-    if untreated_states:
-        # formulate the LP problem
-        linear_program = pulp.LpProblem("reachability", pulp.LpMinimize)
-        # initialize variables
-        for s in untreated_states:
-            x[s] = pulp.LpVariable(s, lowBound=0, upBound=1)
-        # objective function
-        linear_program += sum(x[s] for s in x)
-        # constraints
-        for s in untreated_states:
-            actions_dict = mdp.get_actions(s)
-            for a in actions_dict:
-                linear_program += \
-                    x[s] >= sum(actions_dict[a][ns] * x[ns] for ns in actions_dict[a])
 
+def _solve_lp(a, b, backend, verbose):
+    """
+    Minimise the sum of the variables subject to A @ variables >= b and 0 <= variables <= 1
+    """
+    if backend == 'highs':
+        if verbose > 1:
+            print("LP: {} variables, {} constraints, {} non-zeros".format(a.shape[1], a.shape[0], a.nnz))
+        result = linprog(np.ones(a.shape[1]), A_ub=-a, b_ub=-b, bounds=(0, 1), method='highs')
+        if result.status != 0:
+            raise RuntimeError("HiGHS failed to solve the reachability LP: {}".format(result.message))
+        return result.x
+    elif backend == 'pulp':
+        linear_program = pulp.LpProblem("reachability", pulp.LpMinimize)
+        variables = [pulp.LpVariable('x{}'.format(i), lowBound=0, upBound=1) for i in range(a.shape[1])]
+        linear_program += pulp.lpSum(variables)
+        for r in range(a.shape[0]):
+            columns = a.indices[a.indptr[r]:a.indptr[r + 1]]
+            coefficients = a.data[a.indptr[r]:a.indptr[r + 1]]
+            linear_program += pulp.LpAffineExpression(
+                [(variables[c], coefficients[k]) for k, c in enumerate(columns)]) >= b[r]
         if verbose > 1:
             print(linear_program)
-
-        # solve the LP
         linear_program.solve()
+        return np.array([v.varValue for v in variables], dtype=float)
+    else:
+        raise ValueError("unknown LP backend: {}".format(backend))
 
-        for s in untreated_states:
-            x[s] = x[s].varValue
+
+def _maximal_end_components(compiled, mask):
+    """
+    Maximal end components of the sub-MDP made of the states of boolean array "mask";
+    Return an array with the component id of every state (-1 for states outside any end component)
+    and the number of components
+    """
+    row_len = np.diff(compiled.succ_ptr)
+    owner = compiled.row_state[compiled.trans_row]
+    states = mask.copy()
+    rows = mask[compiled.row_state]
+    while True:
+        active = rows[compiled.trans_row] & states[owner]
+        graph = sp.csr_matrix((np.ones(active.sum()), (owner[active], compiled.succ[active])),
+                              shape=(compiled.n_states, compiled.n_states))
+        _, labels = connected_components(graph, directed=True, connection='strong')
+        # keep the rows whose successors all stay in the strongly connected component of their state,
+        # and the states that keep at least one row
+        inside = states[compiled.succ] & (labels[compiled.succ] == labels[owner])
+        new_rows = rows & states[compiled.row_state] & (compiled.row_sum(inside.astype(float)) == row_len)
+        new_states = states & (np.bincount(compiled.row_state[new_rows], minlength=compiled.n_states) > 0)
+        if (new_rows == rows).all() and (new_states == states).all():
+            break
+        rows, states = new_rows, new_states
+    components = np.full(compiled.n_states, -1, dtype=np.int64)
+    _, components[states] = np.unique(labels[states], return_inverse=True)
+    return components, components.max() + 1
+
+
+def _interval_iteration(compiled, unknown, x, epsilon, lower=None):
+    """
+    Interval iteration for maximal reachability: iterate a lower bound from below and an upper bound
+    from above on the states of boolean array "unknown" (the other values are read from array "x")
+    until they are "epsilon"-close on every state;
+    End components of the undecided states are collapsed for the upper bound, which could get stuck otherwise;
+    "lower" optionally warm-starts the lower bound with known under-approximations;
+    Return (lower bound, upper bound, number of iterations)
+    """
+    components, n_components = _maximal_end_components(compiled, unknown)
+    members = np.flatnonzero(components >= 0)
+    # the rows that stay inside the end component of their state are not exits of the component
+    owner = compiled.row_state[compiled.trans_row]
+    same = (components[compiled.succ] == components[owner]) & (components[owner] >= 0)
+    staying = compiled.row_sum(same.astype(float)) == np.diff(compiled.succ_ptr)
+
+    lo = np.where(unknown, 0., x)
+    if lower is not None:
+        lo[unknown] = np.clip(lower[unknown], 0., 1.)
+    up = np.where(unknown, 1., x)
+    iterations = 0
+    while (up - lo).max(initial=0.) >= epsilon:
+        iterations += 1
+        lo = np.where(unknown, compiled.state_max(compiled.expectation(lo), 0.), lo)
+        q = compiled.expectation(up)
+        q[staying] = 0.
+        best = compiled.state_max(q, 0.)
+        # every end component takes the best exit of its members
+        exits = np.zeros(n_components)
+        np.maximum.at(exits, components[members], best[members])
+        best[members] = exits[components[members]]
+        up = np.where(unknown, np.minimum(up, best), up)
+    return lo, up, iterations
+
+
+def _topological_solve(compiled, unknown, x, backend, verbose):
+    """
+    Exact maximal reachability by a backward pass over the strongly connected components
+    of the states of boolean array "unknown" (the other values are read from array "x"),
+    in reverse topological order;
+    Single-state components (the whole graph when it is acyclic, e.g. an unfolded MDP with
+    negative weights) are solved by one Bellman backup, a generation at a time;
+    Cyclic components (zero-weight cycles) are solved by their own LP
+    """
+    x = x.copy()
+    owner = compiled.row_state[compiled.trans_row]
+    inner = unknown[owner] & unknown[compiled.succ]
+    graph = sp.csr_matrix((np.ones(inner.sum()), (owner[inner], compiled.succ[inner])),
+                          shape=(compiled.n_states, compiled.n_states))
+    n_components, labels = connected_components(graph, directed=True, connection='strong')
+    sizes = np.bincount(labels[unknown], minlength=n_components)
+    self_loop = np.zeros(n_components, dtype=bool)
+    self_loop[labels[owner[inner & (owner == compiled.succ)]]] = True
+    cyclic = (sizes > 1) | self_loop
+    if verbose > 1:
+        print("Topological solver: {} components, {} cyclic".format((sizes > 0).sum(), cyclic.sum()))
+
+    # edges of the condensation; a component is ready once all its successor components are solved
+    cross = inner & (labels[owner] != labels[compiled.succ])
+    cross_fr = labels[owner[cross]]
+    cross_to = labels[compiled.succ[cross]]
+    order = np.argsort(cross_to, kind='stable')
+    cross_fr = cross_fr[order]
+    cross_ptr = np.zeros(n_components + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cross_to, minlength=n_components), out=cross_ptr[1:])
+    pending = np.bincount(cross_fr, minlength=n_components)
+
+    states_by_component = np.argsort(labels, kind='stable')
+    component_ptr = np.zeros(n_components + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_components), out=component_ptr[1:])
+
+    generation = np.flatnonzero((pending == 0) & (sizes > 0))
+    while generation.size:
+        acyclic = generation[~cyclic[generation]]
+        if acyclic.size:
+            states = states_by_component[component_ptr[acyclic]]
+            x[states] = compiled.backup(states, x)
+        for c in generation[cyclic[generation]]:
+            members = np.zeros(compiled.n_states, dtype=bool)
+            members[states_by_component[component_ptr[c]:component_ptr[c + 1]]] = True
+            variables, a, b = _lp_constraints(compiled, members, x)
+            x[variables] = _solve_lp(a, b, backend, verbose)
+        predecessors = cross_fr[gather_segments(cross_ptr, generation)]
+        np.subtract.at(pending, predecessors, 1)
+        generation = np.unique(predecessors[pending[predecessors] == 0])
+    return x
+
+
+def reach(mdp: MDP,
+          targets: list,
+          verbose: int = 1,  # Integer. 0, 1, or 2. Verbosity mode
+          backend: str = 'pulp',  # String. LP solver: 'pulp' (CBC through PuLP) or 'highs' (SciPy)
+          method: str = 'lp',  # String. 'lp', 'topological' (exact) or 'interval' (interval iteration)
+          epsilon: float = 1e-6,  # Float. Precision of the interval iteration
+          fixed: dict = None,  # Dict. States whose values are already known exactly
+          x0: dict = None,  # Dict. Lower bounds of the values (warm start of the interval iteration)
+          stats: Stats = None  # Stats. Stage timings and problem sizes (see instrumentation.py)
+          ):
+    """
+    Compute the maximum probability to reach "targets" from every state of "mdp";
+    With method='interval' the returned values are lower bounds within "epsilon" of the optimum
+    """
+
+    with stage(stats, 'compile'):
+        compiled = mdp.compile()
+    record(stats, 'states', compiled.n_states)
+    record(stats, 'transitions', compiled.n_transitions)
+    # qualitative precomputation: states reaching the targets with probability 0 or 1
+    with stage(stats, 'qualitative'):
+        zero = prob0(mdp, targets)
+        one = prob1(mdp, targets)
+    x = {}
+    for i, k in enumerate(compiled.states):
+        if one[i]:
+            x[k] = 1
+        elif zero[i]:
+            x[k] = 0
+        else:
+            x[k] = -1
+    values = one.astype(float)
+    decided = zero | one
+    if fixed:
+        for k in fixed:
+            x[k] = fixed[k]
+            values[compiled.index[k]] = fixed[k]
+            decided[compiled.index[k]] = True
+
+    # only the undecided states are solved numerically
+    untreated = ~decided
+    record(stats, 'undecided', int(untreated.sum()))
+
+    if untreated.any():
+        variables = np.flatnonzero(untreated)
+        if method == 'lp':
+            with stage(stats, 'lp_build'):
+                _, a, b = _lp_constraints(compiled, untreated, values)
+            record(stats, 'lp_rows', a.shape[0])
+            record(stats, 'lp_nonzeros', a.nnz)
+            with stage(stats, 'lp_solve'):
+                solution = _solve_lp(a, b, backend, verbose)
+        elif method == 'interval':
+            lower = compiled.to_array(x0) if x0 else None
+            with stage(stats, 'interval_iteration'):
+                lo, up, iterations = _interval_iteration(compiled, untreated, values, epsilon, lower)
+            record(stats, 'iterations', iterations)
+            if verbose > 1:
+                print("Interval iteration converged after {} iterations".format(iterations))
+            solution = lo[variables]
+        elif method == 'topological':
+            with stage(stats, 'topological_solve'):
+                solution = _topological_solve(compiled, untreated, values, backend, verbose)[variables]
+        else:
+            raise ValueError("unknown reachability method: {}".format(method))
+        for i, value in zip(variables, np.asarray(solution).tolist()):
+            x[compiled.states[i]] = value
 
     if verbose > 0:
-        print("LP solver of x: ")
+        print({'lp': "LP solver of x: ",
+               'interval': "Interval iteration of x: ",
+               'topological': "Topological solver of x: "}[method])
         pp.pprint(x)
 
     return x
@@ -62,51 +322,177 @@ def reach(mdp: MDP,
 
 def reachability_optimal_policy(mdp: MDP,
                                 targets: list,
-                                verbose: int = 1  # Integer. 0, 1, or 2. Verbosity mode
+                                verbose: int = 1,  # Integer. 0, 1, or 2. Verbosity mode
+                                backend: str = 'pulp',  # String. LP solver: 'pulp' or 'highs'
+                                method: str = 'lp',  # String. 'lp', 'topological' or 'interval'
+                                epsilon: float = 1e-6,  # Float. Precision of the interval iteration
+                                fixed: dict = None,  # Dict. States whose values are already known exactly
+                                x0: dict = None,  # Dict. Lower bounds of the values (warm start)
+                                stats: Stats = None  # Stats. Stage timings and problem sizes
                                 ):
     """
     return a policy that returns the action that maximises the reachability probability to "targets"
     of each state s.
     """
 
-    x = reach(mdp, targets, verbose)
+    x = reach(mdp, targets, verbose, backend, method, epsilon, fixed, x0, stats)
+
+    compiled = mdp.compile()
+    targets = set(targets)
+    # expected reachability score of every action row, then the first best row of every state
+    with stage(stats, 'policy'):
+        best_rows = compiled.state_argmax(compiled.expectation(compiled.to_array(x)))
 
     policy = {}
-    for state in mdp.get_states():
+    for i, state in enumerate(compiled.states):
+        first, last = compiled.action_ptr[i], compiled.action_ptr[i + 1]
         if (state in targets) or (state == BOT):
-            actions_info = mdp.get_actions(state)
-            for action in actions_info:
-                policy[state] = action
+            if last > first:
+                policy[state] = compiled.actions[last - 1]
         else:
-            max_v = -float('inf')
-            actions_info = mdp.get_actions(state)
-            optimal_action = None
-            for action in actions_info:
-                value = 0.
-                for next_state in actions_info[action]:
-                    value += actions_info[action][next_state] * x[next_state]
-                if value > max_v:
-                    max_v = value
-                    optimal_action = action
-            policy[state] = optimal_action
+            policy[state] = compiled.actions[best_rows[i]] if best_rows[i] >= 0 else None
 
     return policy, x
 
 
+def _lazy_percentile(mdp, sources, targets, length, verbose, distance=None):
+    """
+    Percentile problem solved on the fly: the (state, value) nodes reachable from the (source, 0) are generated
+    from the compiled mdp by an iterative depth-first search and solved in post-order, so that only their
+    reach scores and best actions are stored;
+    Return (policy, x) like the unfolded solve, or None when the unfolding is not acyclic
+    (positive weights or cycles of zero-weight transitions between non-target states)
+    """
+    compiled = mdp.compile()
+    is_target = _target_mask(compiled, targets)
+    owner = compiled.row_state[compiled.trans_row]
+    zero = (compiled.weight == 0) & ~is_target[owner] & ~is_target[compiled.succ]
+    if (compiled.weight > 0).any():
+        return None
+    if zero.any():
+        graph = sp.csr_matrix((np.ones(zero.sum()), (owner[zero], compiled.succ[zero])),
+                              shape=(compiled.n_states, compiled.n_states))
+        n_components, _ = connected_components(graph, directed=True, connection='strong')
+        if n_components < compiled.n_states or (owner[zero] == compiled.succ[zero]).any():
+            return None
+
+    action_ptr, succ_ptr = compiled.action_ptr.tolist(), compiled.succ_ptr.tolist()
+    succ, proba = compiled.succ.tolist(), compiled.proba.tolist()
+    # keep integral weights as integers in the (state, value) labels
+    weight = [int(w) if w.is_integer() else w for w in compiled.weight.tolist()]
+    distance = (mdp.distance_to(targets) if distance is None else np.asarray(distance)).tolist()
+    is_target = is_target.tolist()
+
+    x = {}      # (state index, value) -> maximal reach probability
+    best = {}   # (state index, value) -> first best action row, -1 without action
+    opened = set()
+    stack = [((compiled.index[source], 0), False) for source in sources]
+    while stack:
+        node, expanded = stack.pop()
+        i, value = node
+        if not expanded:
+            if node in x or node in opened:
+                continue
+            opened.add(node)
+            stack.append((node, True))
+            if not is_target[i]:
+                for j in range(succ_ptr[action_ptr[i]], succ_ptr[action_ptr[i + 1]]):
+                    next_node = (succ[j], value + weight[j])
+                    if next_node[1] - distance[succ[j]] >= length and next_node not in x:
+                        stack.append((next_node, False))
+            continue
+        opened.discard(node)
+        first, last = action_ptr[i], action_ptr[i + 1]
+        if is_target[i]:
+            # the unfolded targets only keep their self-loops
+            loops = [row for row in range(first, last) if i in succ[succ_ptr[row]:succ_ptr[row + 1]]]
+            x[node], best[node] = 1., loops[-1] if loops else -1
+            continue
+        x[node], best[node] = 0., -1
+        for row in range(first, last):
+            q = 0.
+            for j in range(succ_ptr[row], succ_ptr[row + 1]):
+                next_value = value + weight[j]
+                if next_value - distance[succ[j]] >= length:
+                    q += proba[j] * x[(succ[j], next_value)]
+            if best[node] < 0 or q > x[node]:
+                x[node], best[node] = q, row
+    if verbose > 0:
+        print("Lazy solver: {} (state, value) nodes visited".format(len(x)))
+
+    policy, values = {BOT: 'loop'}, {BOT: 0.}
+    for (i, value), row in best.items():
+        node = (compiled.states[i], value)
+        values[node] = x[(i, value)]
+        if row >= 0:
+            policy[node] = compiled.actions[row]
+        elif not is_target[i]:
+            policy[node] = None
+    return policy, values
+
+
 def guaranteed_short_path(mdp: MDP,
                           source: object,
                           targets: list,
                           length: int,
                           proba_threshold: float = 0.,  # Float in [0, 1]
                           verbose: int = 0,  # Integer. 0, 1, or 2. Verbosity mode
-                          return_x: bool = False  # Boolean. Return reach score "x" or not
+                          return_x: bool = False,  # Boolean. Return reach score "x" or not
+                          backend: str = 'pulp',  # String. LP solver: 'pulp' or 'highs'
+                          method: str = 'topological',  # String. 'topological', 'lazy', 'lp' or 'interval'
+                          epsilon: float = 1e-6,  # Float. Precision of the interval iteration
+                          unfolded_mdp: UnfoldedMDP = None,  # UnfoldedMDP of (mdp, source, targets) to reuse
+                          x0: dict = None,  # Dict. Reach scores "x" of "unfolded_mdp" at its previous threshold
+                          stats: Stats = None  # Stats. Stage timings and problem sizes (see instrumentation.py)
                           ):
     """
     Compute the maximum probability to reach a set of target states "targets" from a initial state "source" of
     a MDP "mdp" with a path length less than a threshold "length" and get the strategy on the unfolded mdp.
+    The default 'topological' method solves the unfolded mdp exactly in one backward pass when it is acyclic
+    (strictly negative weights) and component by component when zero-weight cycles exist.
+    When an "unfolded_mdp" built at a tighter threshold is given, it is extended in place to "length";
+    with its previous reach scores "x0", only the nodes that can reach the extended part are solved again.
+    See "normalized_short_path" to solve it on weights divided by their GCD or bucketed to a resolution.
+    The 'lazy' method solves the reachable (state, value) nodes on the fly without building the unfolded mdp;
+    it falls back to 'topological' when the unfolding has cycles (zero-weight cycles or positive weights).
+    With "stats", the durations of the stages (distance, unfold or extend, qualitative, solve, policy) and the
+    sizes of the unfolded problem are recorded in it.
     """
-    unfolded_mdp = UnfoldedMDP(mdp, source, targets, length, 0)
-    policy, x = reachability_optimal_policy(unfolded_mdp, unfolded_mdp.get_target(), verbose)
+    distance = None
+    if method == 'lazy':
+        if unfolded_mdp is not None:
+            raise ValueError("the lazy method does not build an unfolded mdp to reuse")
+        with stage(stats, 'distance'):
+            distance = mdp.distance_to(targets)
+        with stage(stats, 'lazy_solve'):
+            solved = _lazy_percentile(mdp, [source], targets, length, verbose, distance)
+        if solved is not None:
+            policy, x = solved
+            record(stats, 'visited_nodes', len(x))
+            policy = {node: action for node, action in policy.items() if x[node] >= proba_threshold}
+            return (policy, x) if return_x else policy
+        if verbose > 0:
+            print("Lazy solver: cyclic unfolding, falling back to the topological method")
+        method = 'topological'
+    fixed = None
+    if unfolded_mdp is None:
+        if distance is None:
+            with stage(stats, 'distance'):
+                distance = mdp.distance_to(targets)
+        with stage(stats, 'unfold'):
+            unfolded_mdp = UnfoldedMDP(mdp, source, targets, length, 0, distance)
+    else:
+        with stage(stats, 'extend'):
+            changed = unfolded_mdp.extend(length)
+        record(stats, 'changed_nodes', len(changed))
+        if x0 is not None:
+            compiled = unfolded_mdp.compile()
+            mask = np.zeros(compiled.n_states, dtype=bool)
+            mask[[compiled.index[node] for node in changed]] = True
+            affected = _backward_reachable(compiled, mask)
+            fixed = {node: value for node, value in x0.items() if not affected[compiled.index[node]]}
+    policy, x = reachability_optimal_policy(unfolded_mdp, unfolded_mdp.get_target(), verbose,
+                                            backend, method, epsilon, fixed, x0, stats)
     new_policy = {}
     for state in policy:
         if x[state] >= proba_threshold:
@@ -114,3 +500,274 @@ def guaranteed_short_path(mdp: MDP,
     if return_x:
         return new_policy, x
     return new_policy
+
+
+def normalized_short_path(mdp: MDP,
+                          source: object,
+                          targets: list,
+                          length: float,
+                          proba_threshold: float = 0.,  # Float in [0, 1]
+                          verbose: int = 0,  # Integer. 0, 1, or 2. Verbosity mode
+                          backend: str = 'pulp',  # String. LP solver: 'pulp' or 'highs'
+                          method: str = 'topological',  # String. 'topological', 'lazy', 'lp' or 'interval'
+                          epsilon: float = 1e-6,  # Float. Precision of the interval iteration
+                          resolution: float = None,  # Float. Bucket the weights to multiples of "resolution"
+                          with_bound: bool = True,  # Boolean. Solve the weights rounded up too, for "bound"
+                          stats: Stats = None  # Stats. Stage timings and problem sizes (see instrumentation.py)
+                          ):
+    """
+    "guaranteed_short_path" on the weights of "mdp" divided by a scale (see "normalize_weights"):
+    Without "resolution", the scale is the GCD of the weights: the result is exact and the unfolded mdp is
+    scale times smaller; With a "resolution", the weights are rounded down to multiples of it: the reach
+    scores are lower bounds and "bound" is their gap to the scores of the weights rounded up (0 when exact,
+    None without "with_bound");
+    The accumulated values of the nodes are integers in units of "scale": the nodes are those of the
+    normalized mdp "normalize_weights(mdp, resolution)[0]" (e.g. to simulate the policy), and a value v
+    stands for an accumulated weight of about v * scale (exactly without "resolution");
+    Return (policy, x, bound, scale)
+    """
+    scaled, scale = normalize_weights(mdp, resolution)
+    scaled_length = math.ceil(length / scale)
+    record(stats, 'weight_scale', scale)
+    policy, x = guaranteed_short_path(scaled, source, targets, scaled_length, proba_threshold, verbose,
+                                      True, backend, method, epsilon, stats=stats)
+    bound = 0. if resolution is None else None
+    if resolution is not None and with_bound:
+        optimistic, _ = normalize_weights(mdp, resolution, 'optimistic')
+        _, x_up = guaranteed_short_path(optimistic, source, targets, scaled_length, 0., verbose,
+                                        True, backend, method, epsilon)
+        bound = max(x_up[(source, 0)] - x[(source, 0)], 0.)
+    return policy, x, bound, scale
+
+
+def _solve_sources(mdp, sources, targets, length, distance, verbose, backend, method, epsilon):
+    """
+    Percentile problem from all the "sources" at once on their common unfolding (or lazily)
+    """
+    if method == 'lazy':
+        solved = _lazy_percentile(mdp, sources, targets, length, verbose, distance)
+        if solved is not None:
+            return solved
+        method = 'topological'
+    unfolded_mdp = UnfoldedMDP(mdp, sources[0], targets, length, 0, distance, sources[1:])
+    return reachability_optimal_policy(unfolded_mdp, unfolded_mdp.get_target(), verbose, backend, method, epsilon)
+
+
+def _share_arrays(arrays):
+    """
+    Copy the numpy "arrays" {name: array} into shared memory blocks;
+    Return (blocks, spec) where spec {name: (block name, shape, dtype)} lets a worker attach them
+    """
+    blocks, spec = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        spec[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+
+def _solve_shared_chunk(spec, states, actions, sources, targets, length, verbose, backend, method, epsilon):
+    """
+    Worker of "batch_guaranteed_short_path": attach the shared compiled mdp and solve a chunk of sources
+    """
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, (block, _, _) in spec.items()}
+    try:
+        arrays = {name: np.ndarray(shape, dtype, buffer=blocks[name].buf) for name, (_, shape, dtype) in spec.items()}
+        compiled = CompiledMDP(states, arrays['action_ptr'], actions, arrays['succ_ptr'],
+                               arrays['succ'], arrays['proba'], arrays['weight'])
+        result = _solve_sources(compiled, sources, targets, length, arrays['distance'],
+                                verbose, backend, method, epsilon)
+        # release the views on the blocks before closing them
+        del arrays, compiled
+        return result
+    finally:
+        for block in blocks.values():
+            block.close()
+
+
+def batch_guaranteed_short_path(mdp: MDP,
+                                sources: list,
+                                targets: list,
+                                length: int,
+                                proba_threshold: float = 0.,  # Float in [0, 1]
+                                verbose: int = 0,  # Integer. 0, 1, or 2. Verbosity mode
+                                return_x: bool = False,  # Boolean. Return reach score "x" or not
+                                backend: str = 'pulp',  # String. LP solver: 'pulp' or 'highs'
+                                method: str = 'topological',  # String. 'topological', 'lazy', 'lp' or 'interval'
+                                epsilon: float = 1e-6,  # Float. Precision of the interval iteration
+                                workers: int = None  # Integer. Number of worker processes (None: no pool)
+                                ):
+    """
+    "guaranteed_short_path" from every state of "sources" at once. The compiled mdp and the pruning distances
+    are computed once, and the sources are unfolded together so that a (state, value) node reached from
+    several sources is solved once: the returned strategy serves every source, and x[(source, 0)] is the
+    maximal probability from each of them.
+    With "workers", the sources are split into one chunk per worker, solved in a process pool that reads
+    the compiled arrays from shared memory (the nodes shared by two chunks are solved in both).
+    """
+    compiled = mdp.compile()
+    distance = mdp.distance_to(targets)
+    sources = list(dict.fromkeys(sources))
+    if not workers or workers <= 1 or len(sources) <= 1:
+        policy, x = _solve_sources(compiled, sources, targets, length, distance, verbose, backend, method, epsilon)
+    else:
+        chunks = [sources[k::workers] for k in range(min(workers, len(sources)))]
+        blocks, spec = _share_arrays({'action_ptr': compiled.action_ptr, 'succ_ptr': compiled.succ_ptr,
+                                      'succ': compiled.succ, 'proba': compiled.proba,
+                                      'weight': compiled.weight, 'distance': distance})
+        try:
+            with ProcessPoolExecutor(len(chunks)) as pool:
+                futures = [pool.submit(_solve_shared_chunk, spec, compiled.states, compiled.actions, chunk,
+                                       targets, length, verbose, backend, method, epsilon) for chunk in chunks]
+                policy, x = {}, {}
+                for future in futures:
+                    chunk_policy, chunk_x = future.result()
+                    policy.update(chunk_policy)
+                    x.update(chunk_x)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    policy = {node: action for node, action in policy.items() if x[node] >= proba_threshold}
+    if return_x:
+        return policy, x
+    return policy
+
+
+class CostDistribution:
+    """
+    Maximal probabilities to reach a set of target states "targets" of a MDP "mdp" within every cost budget
+    0, 1, ..., -length, computed in one dynamic-programming pass over the cost layers;
+    table[b][s] is the maximal probability to reach "targets" from s with an accumulated weight >= -b;
+    Weights must be non-positive; they are divided by their GCD "scale" (exact), or bucketed to multiples
+    of "resolution" (rounded down: the probabilities are then lower bounds), and the budgets are multiples
+    of the scale; "normalized" is the MDP of the integer weights w / scale that the policies are keyed on;
+    Zero-weight transitions are solved inside their layer by the topological solver
+    """
+
+    def __init__(self, mdp, targets, length, backend='pulp', verbose=0, resolution=None):
+        mdp, self.scale = normalize_weights(mdp, resolution)
+        self.normalized = mdp
+        compiled = mdp.compile()
+        cost = -compiled.weight
+        if (cost < 0).any():
+            raise ValueError("the cost distribution needs non-positive weights")
+        cost = cost.astype(np.int64)
+        self._compiled = compiled
+        self._targets = list(targets)
+        self._is_target = _target_mask(compiled, targets)
+        self._distance = mdp.distance_to(targets)
+        self.bound = max(self._budget(length), 0)
+
+        n = compiled.n_states
+        owner = compiled.row_state[compiled.trans_row]
+        # zero-weight transitions between non-target states stay in the same layer
+        internal = (cost == 0) & ~self._is_target[owner] & ~self._is_target[compiled.succ]
+        if internal.any():
+            # layer MDP: the internal transitions plus one transition per row to an extra ONE state
+            # whose probability carries the (already known) value of the other transitions
+            keep = np.flatnonzero(internal)
+            rows_len = np.bincount(compiled.trans_row[keep], minlength=compiled.n_rows) + 1
+            succ_ptr = np.zeros(compiled.n_rows + 1, dtype=np.int64)
+            np.cumsum(rows_len, out=succ_ptr[1:])
+            carrier = succ_ptr[1:] - 1
+            succ = np.full(succ_ptr[-1], n, dtype=np.int64)
+            proba = np.zeros(succ_ptr[-1])
+            positions = np.delete(np.arange(succ_ptr[-1]), carrier)
+            succ[positions] = compiled.succ[keep]
+            proba[positions] = compiled.proba[keep]
+            layer = CompiledMDP(compiled.states + ['ONE'], np.append(compiled.action_ptr, compiled.n_rows),
+                                compiled.actions, succ_ptr, succ, proba, np.zeros(len(succ)))
+            one = np.append(self._is_target, True)
+            unknown = ~one & np.append(np.diff(compiled.action_ptr) > 0, False)
+            if verbose > 0:
+                print("Cost distribution: {} zero-weight transitions solved inside the layers".format(len(keep)))
+
+        self.table = np.zeros((self.bound + 1, n))
+        for b in range(self.bound + 1):
+            self.table[b, self._is_target] = 1.
+            lower = b - cost
+            values = np.where(lower >= 0, self.table[np.maximum(lower, 0), compiled.succ], 0.)
+            known = compiled.row_sum(np.where(internal, 0., compiled.proba * values))
+            if internal.any():
+                layer.proba[carrier] = known
+                self.table[b] = _topological_solve(layer, unknown, one.astype(float), backend, verbose)[:n]
+            else:
+                self.table[b] = np.where(self._is_target, 1., compiled.state_max(known, 0.))
+
+    def _budget(self, length):
+        """
+        Number of normalized cost units allowed by the threshold "length"
+        """
+        return math.floor(-length / self.scale + 1e-9)
+
+    def _checked_budget(self, length):
+        bound = self._budget(length)
+        if not 0 <= bound <= self.bound:
+            raise ValueError("length must be between {} and 0".format(-self.bound * self.scale))
+        return bound
+
+    def thresholds(self):
+        """
+        Length thresholds 0, -scale, ..., -bound * scale matching the entries of "curve"
+        """
+        return -np.arange(self.bound + 1) * self.scale
+
+    def curve(self, state):
+        """
+        Maximal probability to reach the targets from "state" for every threshold of "thresholds"
+        """
+        return self.table[:, self._compiled.index[state]].copy()
+
+    def probability(self, state, length):
+        """
+        Maximal probability to reach the targets from "state" with an accumulated weight >= "length"
+        """
+        if length > 0:
+            return 0.
+        return self.table[self._checked_budget(length), self._compiled.index[state]]
+
+    def policy(self, source, length, proba_threshold=0., return_x=False):
+        """
+        Strategy for the threshold "length" from "source", in the format of "guaranteed_short_path":
+        keys are the (state, accumulated value) nodes of the unfolded "normalized" MDP, whose values are
+        integers in units of "scale" (the unit of the accumulated weights in simulate(self.normalized, ...))
+        """
+        compiled = self._compiled
+        bound = self._checked_budget(length)
+        length = -bound
+        cost = (-compiled.weight).astype(np.int64)
+        row_len = np.diff(compiled.succ_ptr)
+        policy = {BOT: 'loop'}
+        x = {BOT: 0.}
+        root = (source, 0)
+        seen = {root}
+        worklist = deque([root])
+        while worklist:
+            state, value = node = worklist.popleft()
+            i = compiled.index[state]
+            b = value + bound
+            x[node] = self.table[b, i]
+            first, last = compiled.action_ptr[i], compiled.action_ptr[i + 1]
+            if self._is_target[i]:
+                if last > first:
+                    policy[node] = compiled.actions[last - 1]
+                continue
+            if last == first:
+                policy[node] = None
+                continue
+            transitions = np.arange(compiled.succ_ptr[first], compiled.succ_ptr[last])
+            lower = b - cost[transitions]
+            values = np.where(lower >= 0, self.table[np.maximum(lower, 0), compiled.succ[transitions]], 0.)
+            q = np.add.reduceat(compiled.proba[transitions] * values, row_len[first:last].cumsum() - row_len[first:last])
+            policy[node] = compiled.actions[first + int(np.argmax(q))]
+            for j in transitions:
+                next_node = (compiled.states[compiled.succ[j]], value + int(compiled.weight[j]))
+                if next_node[1] - self._distance[compiled.succ[j]] >= length and next_node not in seen:
+                    seen.add(next_node)
+                    worklist.append(next_node)
+        policy = {node: action for node, action in policy.items() if x[node] >= proba_threshold}
+        if return_x:
+            return policy, x
+        return policy
@@ -8,6 +8,7 @@
 from mdp import MDP, UnfoldedMDP
 from my_env import *
 from SSPP import guaranteed_short_path
+from simulator import simulate
 import random
 
 
@@ -43,3 +44,7 @@ m.generate_from_my_format(state_2_action, action_2_state)
 pi = guaranteed_short_path(m, 'home', ['work'], -45, 0, 0)
 run(m, 'home', ['work'], pi, 10)
 
+# success rate of the policy over many episodes simulated at once
+result = simulate(m, pi, 'home', ['work'], episodes=100000)
+print(result, 'P(length >= -45) =', result.probability(-45))
+
@@ -0,0 +1,143 @@
+# -----------------------------------------------------------
+# Benchmark script
+#
+# -----------------------------------------------------------
+
+"""
+Benchmarks of the unfolding, reachability and learning functions on synthetic MDPs of increasing size;
+one JSON line per (benchmark, model, size) with the best wall time and the peak traced memory
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from mdp import MDP, UnfoldedMDP, CompiledMDP
+from my_env import state_2_action, action_2_state
+from frozenlake import FrozenLakeMDP, generate_map
+from SSPP import reach, guaranteed_short_path
+from SSPE import vi, q_learn, monte_carlo
+import numpy as np
+
+
+def commute_mdp(copies: int):
+    """
+    "copies" commute models of my_env.py in a row: the work of a copy is the home of the next one
+    """
+    def name(state, k):
+        if state == 'home':
+            return 'home' if k == 0 else 'work_{}'.format(k - 1)
+        if state == 'work':
+            return 'work_{}'.format(k)
+        return '{}_{}'.format(state, k)
+
+    s2a, a2s = {}, {}
+    for k in range(copies):
+        for state, actions in state_2_action.items():
+            if state == 'work' and k < copies - 1:
+                continue
+            s2a[name(state, k)] = {'{}_{}'.format(a, k): w for a, w in actions.items()}
+            for a in actions:
+                a2s['{}_{}'.format(a, k)] = {name(s, k): p for s, p in action_2_state[a].items()}
+    mdp = MDP()
+    mdp.generate_from_my_format(s2a, a2s)
+    return mdp, 'home', 'work_{}'.format(copies - 1), -45 * copies
+
+
+def random_mdp(n: int, n_actions: int = 3, branching: int = 3, seed: int = 0):
+    """
+    Random sparse MDP of "n" states, "n_actions" actions per state with "branching" successors and integer
+    weights in [-5, -1]; the last state is the target (it loops on itself)
+    """
+    rng = np.random.default_rng(seed)
+    rows = (n - 1) * n_actions + 1
+    action_ptr = np.append(np.arange(n) * n_actions, rows)
+    succ_ptr = np.append(np.arange(rows - 1) * branching, [(rows - 1) * branching, (rows - 1) * branching + 1])
+    succ = np.append(rng.integers(0, n, (rows - 1) * branching), n - 1)
+    proba = rng.dirichlet(np.ones(branching), rows - 1).ravel()
+    weight = np.repeat(rng.integers(-5, 0, rows - 1), branching).astype(float)
+    compiled = CompiledMDP(range(n), action_ptr, [k % n_actions for k in range(rows)], succ_ptr, succ,
+                           np.append(proba, 1.), np.append(weight, 0.))
+    return MDP.from_compiled(compiled), 0, n - 1, -20
+
+
+def frozenlake_mdp(size: int, seed: int = 0):
+    """
+    size x size FrozenLake with 10% of holes
+    """
+    mdp = FrozenLakeMDP(desc=generate_map(size, 0.1, seed=seed))
+    return mdp, mdp.starting_point, mdp.goal, -4 * size
+
+
+MODELS = {
+    'commute': (commute_mdp, [1, 10, 100, 1000]),
+    'random': (random_mdp, [100, 1000, 10000, 100000]),
+    'frozenlake': (frozenlake_mdp, [4, 8, 16, 32]),
+}
+
+BENCHMARKS = {
+    'unfold': lambda mdp, s, t, length: UnfoldedMDP(mdp, s, [t], length),
+    'reach': lambda mdp, s, t, length: reach(mdp, [t], 0, 'highs', 'topological'),
+    'guaranteed_short_path': lambda mdp, s, t, length: guaranteed_short_path(mdp, s, [t], length, backend='highs'),
+    'guaranteed_short_path_lazy': lambda mdp, s, t, length: guaranteed_short_path(mdp, s, [t], length,
+                                                                                  method='lazy'),
+    'vi': lambda mdp, s, t, length: vi(mdp, s, t, episodes=1000),
+    'q_learn': lambda mdp, s, t, length: q_learn(mdp, s, t, episodes=2000, verbose=0, max_steps=200, seed=0),
+    'monte_carlo': lambda mdp, s, t, length: monte_carlo(mdp, s, t, episodes=2000, verbose=0, max_steps=200,
+                                                         seed=0),
+}
+
+
+def measure(function, repeat):
+    """
+    Best wall time over "repeat" runs, then the peak of the memory traced by tracemalloc over one more run
+    (kept apart since tracing slows the Python code down)
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--levels', type=int, default=3, help='number of sizes of every model')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every measure')
+    parser.add_argument('--output', default='-', help='JSON lines file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'a')
+    context = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()}
+    try:
+        for model in args.models:
+            build, sizes = MODELS[model]
+            for size in sizes[:args.levels]:
+                start = time.perf_counter()
+                mdp, source, target, length = build(size)
+                compiled = mdp.compile()
+                build_seconds = time.perf_counter() - start
+                for benchmark in args.benchmarks:
+                    seconds, peak = measure(lambda: BENCHMARKS[benchmark](mdp, source, target, length), args.repeat)
+                    record = dict(context, benchmark=benchmark, model=model, size=size, length=length,
+                                  states=compiled.n_states, transitions=compiled.n_transitions,
+                                  build_seconds=build_seconds, seconds=seconds, repeat=args.repeat,
+                                  peak_bytes=peak)
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
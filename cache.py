@@ -0,0 +1,198 @@
+# -----------------------------------------------------------
+# Content-addressed cache of unfolded MDPs and percentile results:
+# in-memory LRU with an optional on-disk tier
+#
+# -----------------------------------------------------------
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import shutil
+from mdp import MDP, UnfoldedMDP
+from SSPP import guaranteed_short_path, reachability_optimal_policy
+import storage
+
+
+def query_key(mdp: MDP, kind: str, *params):
+    """
+    Hex key of a query "kind" with the parameters "params" on the MDP "mdp" (see "MDP.fingerprint")
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(mdp.fingerprint().encode())
+    digest.update(pickle.dumps((kind,) + params, protocol=4))
+    return digest.hexdigest()
+
+
+def _size_of(value):
+    if isinstance(value, UnfoldedMDP):
+        return value.nbytes
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class ResultCache:
+    """
+    Cache of unfolded MDPs and (policy, x) results keyed by "query_key";
+    The memory tier is an LRU bounded by "max_bytes" (sizes of the pickled results / unfolded arrays);
+    With a "directory", every entry is also written there (results pickled, unfolded MDPs with "storage.save"
+      and memory-mapped back) and the least recently used files are removed beyond "max_disk_bytes";
+    The cached policies and reach scores are shared between the callers and must not be modified;
+    The cached unfolded MDPs are solved as they are (never extended) and hold no compiled form between calls
+    """
+
+    def __init__(self,
+                 max_bytes: int = 256 * 2 ** 20,  # Integer. Size bound of the memory tier
+                 directory: str = None,  # String. Directory of the disk tier (None: memory only)
+                 max_disk_bytes: int = 4 * 2 ** 30  # Integer. Size bound of the disk tier
+                 ):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self._bytes}
+
+    def clear(self):
+        """
+        Empty the memory tier (the disk tier is kept)
+        """
+        self._entries.clear()
+        self._bytes = 0
+
+    def get(self, key):
+        """
+        Cached value of "key" (None when missing)
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        value = self._read(key)
+        if value is not None:
+            self.disk_hits += 1
+            self._remember(key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.directory is not None:
+            self._write(key, value)
+
+    def _remember(self, key, value):
+        size = _size_of(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+            self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        if os.path.isdir(path):
+            if not os.path.isfile(os.path.join(path, 'meta.json')):
+                # interrupted "storage.save": incomplete entry
+                shutil.rmtree(path, ignore_errors=True)
+                return None
+            value = storage.load(path)
+        elif os.path.isfile(path + '.pkl'):
+            path += '.pkl'
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        else:
+            return None
+        # the modification time orders the disk tier
+        os.utime(path)
+        return value
+
+    def _write(self, key, value):
+        if isinstance(value, UnfoldedMDP):
+            storage.save(value, self._path(key))
+        else:
+            with open(self._path(key) + '.pkl', 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            else:
+                size = os.path.getsize(path)
+            files.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= size
+
+    def unfolded(self, mdp: MDP, source, targets: list, length):
+        """
+        UnfoldedMDP of (mdp, source, targets, length), built once
+        """
+        key = query_key(mdp, 'unfolded', source, list(targets), length)
+        unfolded_mdp = self.get(key)
+        if unfolded_mdp is None:
+            unfolded_mdp = UnfoldedMDP(mdp, source, targets, length)
+            self.put(key, unfolded_mdp)
+        return unfolded_mdp
+
+    def guaranteed_short_path(self,
+                              mdp: MDP,
+                              source: object,
+                              targets: list,
+                              length: int,
+                              proba_threshold: float = 0.,  # Float in [0, 1]
+                              verbose: int = 0,  # Integer. 0, 1, or 2. Verbosity mode
+                              return_x: bool = False,  # Boolean. Return reach score "x" or not
+                              backend: str = 'pulp',  # String. LP solver: 'pulp' or 'highs'
+                              method: str = 'topological',  # String. 'topological', 'lazy', 'lp' or 'interval'
+                              epsilon: float = 1e-6  # Float. Precision of the interval iteration
+                              ):
+        """
+        "SSPP.guaranteed_short_path" answered from the cache; the full (policy, x) is cached once for all the
+        probability thresholds, and the unfolded MDP it was solved on is cached as well
+        """
+        key = query_key(mdp, 'guaranteed_short_path', source, list(targets), length, backend, method, epsilon)
+        result = self.get(key)
+        if result is None:
+            if method == 'lazy':
+                result = guaranteed_short_path(mdp, source, targets, length, 0., verbose, True,
+                                               backend, method, epsilon)
+            else:
+                # solved in place: extending it would copy memory-mapped arrays into private buffers
+                unfolded_mdp = self.unfolded(mdp, source, targets, length)
+                result = reachability_optimal_policy(unfolded_mdp, unfolded_mdp.get_target(), verbose,
+                                                     backend, method, epsilon)
+                # the compiled form is several times the size counted by the LRU
+                unfolded_mdp.invalidate()
+            self.put(key, result)
+        policy, x = result
+        if proba_threshold > 0:
+            policy = {node: action for node, action in policy.items() if x[node] >= proba_threshold}
+        if return_x:
+            return policy, x
+        return policy
@@ -0,0 +1,111 @@
+# -----------------------------------------------------------
+# Exact evaluation of policies: the Markov chain induced by a
+# policy is solved as an absorbing chain with sparse linear algebra
+#
+# -----------------------------------------------------------
+
+from mdp import MDP
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order
+from scipy.sparse.linalg import spsolve
+
+
+def _policy_table(compiled, policy):
+    """
+    Return (stationary, {state index or (state index, value): row}) of a policy (see "CompiledMDP.policy_rows")
+    """
+    states, values, rows = compiled.policy_rows(policy)
+    if values is None:
+        return True, dict(zip(states.tolist(), rows.tolist()))
+    return False, dict(zip(zip(states.tolist(), values), rows.tolist()))
+
+
+def evaluate_policy(mdp: MDP,
+                    policy: dict,  # Dict. {state: action} or {(state, value): action} of "guaranteed_short_path"
+                    initial_state: object,
+                    targets: list,
+                    length: float = None,  # Float. Threshold of the accumulated weight (None: no threshold)
+                    init_value: float = 0,  # Float. Initial accumulated value of the (state, value) policies
+                    return_x: bool = False  # Boolean. Return the probabilities of every node of the chain
+                    ):
+    """
+    Exact probability that "policy" reaches "targets" from "initial_state" with an accumulated weight >= "length"
+    (weights being non-positive), and expected accumulated weight of the runs that do so;
+    The chain induced by the policy is built over the reachable states, or (state, value) nodes for a
+      threshold or a history-dependent policy; targets and nodes past the threshold or without action absorb;
+    x = Q x + b and y = Q y + r (y: expected weight of the successful runs) are solved on the transient nodes
+      that can reach a target, the other ones having probability 0;
+    Return (probability, expected weight) and the dict x of the node probabilities when "return_x"
+    """
+    compiled = mdp.compile()
+    is_target = np.zeros(compiled.n_states, dtype=bool)
+    is_target[[compiled.index[t] for t in targets if t in compiled.index]] = True
+    stationary, table = _policy_table(compiled, policy)
+    track = length is not None or not stationary
+
+    # chain over the reachable nodes, built breadth-first (nodes are numbered in discovery order)
+    start = (compiled.index[initial_state], init_value if track else None)
+    ids = {start: 0}
+    nodes = [start]
+    success, transient = [], []
+    src, dst, proba, weight = [], [], [], []
+    k = 0
+    while k < len(nodes):
+        i, value = nodes[k]
+        row = table.get((i, value) if not stationary else i)
+        within = length is None or value >= length
+        if within and is_target[i]:
+            success.append(k)
+        elif within and row is not None:
+            transient.append(k)
+            for j in range(compiled.succ_ptr[row], compiled.succ_ptr[row + 1]):
+                w = compiled.weight[j]
+                next_node = (int(compiled.succ[j]), value + (int(w) if w.is_integer() else w) if track else None)
+                if next_node not in ids:
+                    ids[next_node] = len(nodes)
+                    nodes.append(next_node)
+                src.append(k)
+                dst.append(ids[next_node])
+                proba.append(compiled.proba[j])
+                weight.append(w)
+        k += 1
+
+    n = len(nodes)
+    src, dst = np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64)
+    proba, weight = np.array(proba), np.array(weight)
+    # nodes that can reach a target: backward search from an extra node n linked to the targets
+    reverse = sp.csr_matrix((np.ones(len(src) + len(success)), (np.concatenate((dst, np.full(len(success), n))),
+                                                                np.concatenate((src, success)))),
+                            shape=(n + 1, n + 1))
+    alive = np.zeros(n + 1, dtype=bool)
+    alive[breadth_first_order(reverse, n, directed=True, return_predecessors=False)] = True
+    alive = alive[:n]
+
+    x, y = np.zeros(n), np.zeros(n)
+    x[success] = 1.
+    unknown = np.zeros(n, dtype=bool)
+    unknown[transient] = True
+    unknown &= alive
+    variables = np.flatnonzero(unknown)
+    if len(variables):
+        position = np.full(n, -1, dtype=np.int64)
+        position[variables] = np.arange(len(variables))
+        inner = unknown[src] & unknown[dst]
+        outer = unknown[src] & ~unknown[dst]
+        q = sp.csr_matrix((proba[inner], (position[src[inner]], position[dst[inner]])),
+                          shape=(len(variables), len(variables)))
+        a = (sp.identity(len(variables), format='csr') - q).tocsc()
+        b = np.bincount(position[src[outer]], weights=proba[outer] * x[dst[outer]], minlength=len(variables))
+        x[variables] = np.atleast_1d(spsolve(a, b))
+        keep = unknown[src]
+        r = np.bincount(position[src[keep]], weights=proba[keep] * weight[keep] * x[dst[keep]],
+                        minlength=len(variables))
+        y[variables] = np.atleast_1d(spsolve(a, r))
+
+    probability = float(x[0])
+    expected = float(y[0] / x[0]) if x[0] > 0 else float('nan')
+    if return_x:
+        labels = [compiled.states[i] if not track else (compiled.states[i], value) for i, value in nodes]
+        return probability, expected, dict(zip(labels, x.tolist()))
+    return probability, expected
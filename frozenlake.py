@@ -4,9 +4,10 @@
 # And an agent for calculating the policy using SSPP algorithm
 # -----------------------------------------------------------
 
-from mdp import MDP
+from mdp import MDP, CompiledMDP
+import numpy as np
 from SSPP import guaranteed_short_path
-from SSPE import q_learn, monte_carlo, vi
+from SSPE import q_learn, monte_carlo, vi, policy_iteration
 
 LEFT = 0
 UP = 1
@@ -15,120 +16,115 @@ DOWN = 3
 DONE = -1  # at holes or at goal
 
 
+MAPS = {
+    "4x4": ["SFFF",
+            "FHFH",
+            "FFFH",
+            "HFFG"],
+    "8x8": ["SFFFFFFF",
+            "FFFFFFFF",
+            "FFFHFFFF",
+            "FFFFFHFF",
+            "FFFHFFFF",
+            "FHHFFFHF",
+            "FHFFHFHF",
+            "FFFHFFFG"],
+}
+
+# an action slips to one of three moves with probability 1/3 (same order as gym)
+SLIPS = np.array([[UP, LEFT, DOWN],  # left
+                  [LEFT, UP, RIGHT],  # up
+                  [UP, RIGHT, DOWN],  # right
+                  [RIGHT, DOWN, LEFT]])  # down
+
+
+def generate_map(size: int = 8,
+                 p: float = 0.2,  # Float in [0, 1]. Probability of a cell to be a hole
+                 seed: int = None  # Integer. Seed of the random generator
+                 ):
+    """
+    Random size x size map (list of strings, like gym's "desc") with holes of density "p",
+    drawn again until the goal (bottom right) is reachable from the start (top left)
+    """
+    rng = np.random.default_rng(seed)
+    while True:
+        holes = rng.random((size, size)) < p
+        holes[0, 0] = holes[-1, -1] = False
+        # reachability of the goal through the frozen cells (4-neighbourhood), by repeated dilation
+        reached = np.zeros((size, size), dtype=bool)
+        reached[0, 0] = True
+        while True:
+            grown = reached.copy()
+            grown[1:, :] |= reached[:-1, :]
+            grown[:-1, :] |= reached[1:, :]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            grown &= ~holes
+            if (grown == reached).all():
+                break
+            reached = grown
+        if reached[-1, -1]:
+            cells = np.where(holes, 'H', 'F')
+            cells[0, 0], cells[-1, -1] = 'S', 'G'
+            return [''.join(row) for row in cells]
+
+
 class FrozenLakeMDP(MDP):
     """
-    v1: only create a 4x4 map as below
+    MDP of a FrozenLake map given as a list of strings (gym's "desc"), by default
+    v1: the 4x4 map MAPS["4x4"]
     SFFF       (S: starting point, safe)
     FHFH       (F: frozen surface, safe)
     FFFH       (H: hole, fall to your doom)
     HFFG       (G: goal, where the frisbee is located)
-
-
-    v2: be able to create a 8x8 map as below
-    "SFFFFFFF",
-    "FFFFFFFF",
-    "FFFHFFFF",
-    "FFFFFHFF",
-    "FFFHFFFF",
-    "FHHFFFHF",
-    "FHFFHFHF",
-    "FFFHFFFG"
+    v2: the 8x8 map MAPS["8x8"] ("new_map")
+    States are the cells row * n_col + col; every move costs 1 and slips (see SLIPS);
+    Holes and the goal loop on themselves with the action DONE;
+    The transition arrays are built at once with numpy (see "MDP.from_compiled"): the NetworkX graph is
+      only materialized when needed
     """
 
     def __init__(self,
-                 new_map: bool = False  # v2: True: create a MDP of FrozenLake 8x8
+                 new_map: bool = False,  # v2: True: create a MDP of FrozenLake 8x8
                  #     False: create a MDP of FrozenLake 4x4
+                 desc: list = None  # List of strings. Any map (see "generate_map"), overrides "new_map"
                  ):
         super().__init__()
-
-        if new_map:
-            n_row = 8
-            n_col = 8
-            states = list(range(64))
-            actions = list(range(4))
-            holes = [2 * 8 + 3, 3 * 8 + 5, 4 * 8 + 4, 5 * 8 + 1, 5 * 8 + 2, 5 * 8 + 6, 6 * 8 + 1, 6 * 8 + 4, 6 * 8 + 6,
-                     7 * 8 + 3]
-
-            self.starting_point = 0
-            self.goal = 63
-        else:
-            n_row = 4
-            n_col = 4
-            states = list(range(16))
-            actions = list(range(4))
-            holes = [5, 7, 11, 12]
-
-            self.starting_point = 0
-            self.goal = 15
-
-        def to_s(_row, _col):
-            return _row * n_col + _col
-
-        def to_row_col(_state):
-            _row = _state // n_col
-            _col = _state - _row * n_col
-            return _row, _col
-
-        def inc(_row, _col, _a):
-            if _a == LEFT:  # left
-                _col = max(_col - 1, 0)
-            elif _a == UP:  # up
-                _row = min(_row + 1, n_row - 1)
-            elif _a == RIGHT:  # right
-                _col = min(_col + 1, n_col - 1)
-            elif _a == DOWN:  # down
-                _row = max(_row - 1, 0)
-            return _row, _col
-
-        def random_action_set(_a):
-            if _a == LEFT:  # left -> [UP, LEFT, DOWN]
-                actions_set = [UP, LEFT, DOWN]
-            elif _a == UP:  # up -> [LEFT, UP, RIGHT]
-                actions_set = [LEFT, UP, RIGHT]
-            elif _a == RIGHT:  # right -> [UP, RIGHT, DOWN]
-                actions_set = [UP, RIGHT, DOWN]
-            elif _a == DOWN:  # down -> [RIGHT, DOWN, LEFT]
-                actions_set = [RIGHT, DOWN, LEFT]
-            return actions_set
-
-        for state in states:
-            self._g.add_node(state)
-        for state in states:
-            row, col = to_row_col(state)
-            if state in holes:
-                self._g.add_edge(state, state, key=DONE,
-                                 action=DONE,
-                                 weight=-1,
-                                 length=1,
-                                 fr=state,
-                                 to=state,
-                                 proba=1,
-                                 )
-            elif state == self.goal:
-                self._g.add_edge(state, state, key=DONE,
-                                 action=DONE,
-                                 weight=0,
-                                 length=0,
-                                 fr=state,
-                                 to=state,
-                                 proba=1,
-                                 )
-            else:
-                for action in actions:
-                    rnd_set = random_action_set(action)
-                    next_states = [to_s(*inc(row, col, a)) for a in rnd_set]
-                    for next_state in next_states:
-                        if not self._g.has_edge(state, next_state, key=action):
-                            self._g.add_edge(state, next_state, key=action,
-                                             action=action,
-                                             weight=-1,
-                                             length=1,
-                                             fr=state,
-                                             to=next_state,
-                                             proba=1 / 3,
-                                             )
-                        else:
-                            self._g[state][next_state][action]['proba'] += 1 / 3
+        if desc is None:
+            desc = MAPS["8x8" if new_map else "4x4"]
+        cells = np.array([list(row) for row in desc])
+        n_row, n_col = cells.shape
+        cells = cells.ravel()
+        n = n_row * n_col
+        self.desc = list(desc)
+        self.starting_point = int(np.flatnonzero(cells == 'S')[0])
+        self.goal = int(np.flatnonzero(cells == 'G')[0])
+
+        # holes and goal have one action row (DONE), the other cells the four moves
+        terminal = (cells == 'H') | (cells == 'G')
+        n_actions = np.where(terminal, 1, 4)
+        action_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(n_actions, out=action_ptr[1:])
+        row_state = np.repeat(np.arange(n), n_actions)
+        row_action = np.arange(len(row_state)) - action_ptr[row_state]
+        row_action[terminal[row_state]] = DONE
+
+        # the three slipping moves of every row (terminal rows stay in place)
+        moves = SLIPS[np.maximum(row_action, 0)]
+        row, col = (row_state // n_col)[:, None], (row_state % n_col)[:, None]
+        row = np.clip(row + (moves == UP) - (moves == DOWN), 0, n_row - 1)
+        col = np.clip(col + (moves == RIGHT) - (moves == LEFT), 0, n_col - 1)
+        candidates = np.where(terminal[row_state][:, None], row_state[:, None], row * n_col + col)
+        # merge the moves leading to the same cell
+        same = candidates[:, :, None] == candidates[:, None, :]
+        keep = ~np.tril(same, -1).any(axis=2)
+        succ_ptr = np.zeros(len(row_state) + 1, dtype=np.int64)
+        np.cumsum(keep.sum(axis=1), out=succ_ptr[1:])
+        weight = np.where(cells[row_state] == 'G', 0., -1.)
+
+        self._load_compiled(CompiledMDP(range(n), action_ptr, row_action.tolist(), succ_ptr,
+                                        candidates[keep], same.sum(axis=2)[keep] / 3,
+                                        np.repeat(weight, keep.sum(axis=1))))
 
 
 class FrozenLakeAgent:
@@ -144,13 +140,16 @@ class FrozenLakeAgent:
                  # False: create a MDP of FrozenLake 4x4
                  max_length: int = -50,
                  # steps that target to move to the goal within the number of steps
+                 desc: list = None,
+                 # any map as a list of strings (overrides big_map)
                  ):
-        self.mdp = FrozenLakeMDP(new_map=big_map)
+        self.mdp = FrozenLakeMDP(new_map=big_map, desc=desc)
         self._max_length = max_length
         pi, x = guaranteed_short_path(self.mdp, self.mdp.starting_point,
                                       [self.mdp.goal], max_length, return_x=True)
-        policy = [-1] * (63 if big_map else 15)
-        for i in range(63 if big_map else 15):
+        n_states = len(self.mdp.get_states())
+        policy = [-1] * n_states
+        for i in range(n_states):
             for k in range(len(pi)):
                 if (i, -k) in pi:
                     policy[i] = pi[(i, -k)]
@@ -168,9 +167,11 @@ class Agent:
                  big_map: bool = False,
                  # True: create a MDP of FrozenLake 8x8
                  # False: create a MDP of FrozenLake 4x4
+                 desc: list = None,
+                 # any map as a list of strings (overrides big_map)
                  ):
-        self.mdp = FrozenLakeMDP(new_map=big_map)
-        self._policy = [-1] * (63 if big_map else 15)
+        self.mdp = FrozenLakeMDP(new_map=big_map, desc=desc)
+        self._policy = [-1] * len(self.mdp.get_states())
 
     def get_policy(self):
         return self._policy
@@ -187,9 +188,11 @@ class QLearnAgent(Agent):
                  eps_min=0.1,
                  eps_decade=0.9,
                  episodes=50,
-                 verbose=0  # Integer. 0, 1, or 2. Verbosity mode
+                 verbose=0,  # Integer. 0, 1, or 2. Verbosity mode
+                 desc: list = None,
+                 # any map as a list of strings (overrides big_map)
                  ):
-        super().__init__(big_map=big_map)
+        super().__init__(big_map=big_map, desc=desc)
         self._q = {}
         self._q, pi = q_learn(markov=self.mdp,
                               initial_state=self.mdp.starting_point,
@@ -207,8 +210,10 @@ class VIAgent(Agent):
                  # False: create a MDP of FrozenLake 4x4
                  gamma=1.,
                  episodes=50,
+                 desc: list = None,
+                 # any map as a list of strings (overrides big_map)
                  ):
-        super().__init__(big_map=big_map)
+        super().__init__(big_map=big_map, desc=desc)
         self._q = {}
         self._q, pi = vi(markov=self.mdp,
                          initial_state=self.mdp.starting_point,
@@ -216,3 +221,23 @@ class VIAgent(Agent):
                          gamma=gamma,
                          episodes=episodes)
         self._policy = list(pi.values())
+
+
+class PIAgent(Agent):
+    def __init__(self,
+                 big_map: bool = False,
+                 # True: create a MDP of FrozenLake 8x8
+                 # False: create a MDP of FrozenLake 4x4
+                 gamma=1.,
+                 episodes=50,
+                 desc: list = None,
+                 # any map as a list of strings (overrides big_map)
+                 ):
+        super().__init__(big_map=big_map, desc=desc)
+        self._v = {}
+        self._v, pi = policy_iteration(markov=self.mdp,
+                                       initial_state=self.mdp.starting_point,
+                                       terminal_state=self.mdp.goal,
+                                       gamma=gamma,
+                                       episodes=episodes)
+        self._policy = list(pi.values())
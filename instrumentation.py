@@ -0,0 +1,83 @@
+# -----------------------------------------------------------
+# Instrumentation of the solvers: stage timings, sizes and
+# convergence measures reported through a Stats object
+#
+# -----------------------------------------------------------
+
+from contextlib import contextmanager
+import time
+
+
+class Stats:
+    """
+    Measures of one or more solver calls:
+    "timings" {stage: seconds} (summed when a stage runs several times),
+    "counters" {name: value} (the last value recorded) and "series" {name: [values]} (e.g. residuals);
+    "callback", when given, is called with (kind, name, value) for every measure as it is recorded,
+      kind being 'timing', 'counter' or 'series'
+    """
+
+    def __init__(self, callback=None):
+        self.timings = {}
+        self.counters = {}
+        self.series = {}
+        self.callback = callback
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.) + seconds
+        if self.callback is not None:
+            self.callback('timing', stage, seconds)
+
+    def count(self, name, value):
+        self.counters[name] = value
+        if self.callback is not None:
+            self.callback('counter', name, value)
+
+    def append(self, name, value):
+        self.series.setdefault(name, []).append(value)
+        if self.callback is not None:
+            self.callback('series', name, value)
+
+    def as_dict(self):
+        return {'timings': dict(self.timings), 'counters': dict(self.counters),
+                'series': {name: list(values) for name, values in self.series.items()}}
+
+    def __repr__(self):
+        return "Stats(timings={}, counters={})".format(self.timings, self.counters)
+
+
+@contextmanager
+def _timed(stats, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+
+
+class _Untimed:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_UNTIMED = _Untimed()
+
+
+def stage(stats, name):
+    """
+    Context manager adding the duration of its block to stats.timings[name]; a shared no-op when "stats" is None
+    """
+    if stats is None:
+        return _UNTIMED
+    return _timed(stats, name)
+
+
+def record(stats, name, value):
+    """
+    stats.count(name, value), skipped when "stats" is None
+    """
+    if stats is not None:
+        stats.count(name, value)
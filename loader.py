@@ -0,0 +1,147 @@
+# -----------------------------------------------------------
+# Streaming loader of transition tables (state, action, next_state,
+# probability, weight) from CSV or Parquet files into compiled MDPs
+#
+# -----------------------------------------------------------
+
+import csv
+from mdp import MDP, CompiledMDP
+import numpy as np
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet files need pyarrow
+    pq = None
+
+COLUMNS = ('state', 'action', 'next_state', 'probability', 'weight')
+
+
+def _csv_chunks(path, columns, chunk_size, delimiter):
+    with open(path, newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader)
+        position = [header.index(column) for column in columns]
+        # filled column by column: no per-row container is kept alive
+        chunk = [[] for _ in columns]
+        for line in reader:
+            if line:
+                for values, p in zip(chunk, position):
+                    values.append(line[p])
+            if len(chunk[0]) == chunk_size:
+                yield chunk
+                chunk = [[] for _ in columns]
+        if chunk[0]:
+            yield chunk
+
+
+def _parquet_chunks(path, columns, chunk_size):
+    if pq is None:
+        raise ImportError("reading Parquet files needs pyarrow")
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=list(columns)):
+        yield [batch.column(i).to_pylist() for i in range(len(columns))]
+
+
+class _Labels:
+    """
+    Dense integer ids of labels in order of first appearance, assigned chunk by chunk;
+    "convert" is applied once per distinct raw value
+    """
+
+    def __init__(self, convert=None):
+        self.raw = {}  # raw value -> id
+        self.ids = {}  # converted label -> id
+        self.labels = []
+        self.convert = convert
+
+    def encode(self, values):
+        get = self.raw.get
+        codes = np.array([get(value, -1) for value in values], dtype=np.int64)
+        # values not seen in the previous chunks, in order
+        for i in np.flatnonzero(codes < 0).tolist():
+            value = values[i]
+            code = self.raw.get(value)
+            if code is None:
+                label = value if self.convert is None else self.convert(value)
+                code = self.ids.get(label)
+                if code is None:
+                    code = self.ids[label] = len(self.labels)
+                    self.labels.append(label)
+                self.raw[value] = code
+            codes[i] = code
+        return codes
+
+
+def load_transitions(path: str,
+                     file_format: str = None,  # String. 'csv' or 'parquet' (None: from the file extension)
+                     chunk_size: int = 1000000,  # Integer. Number of rows read at once
+                     columns: tuple = COLUMNS,  # Tuple. Names of the state, action, next state, probability
+                     #                            and weight columns
+                     state_type: type = None,  # Callable. Conversion of the state labels (e.g. int), on CSV files
+                     delimiter: str = ',',  # String. CSV delimiter
+                     tol: float = 1e-6  # Float. Tolerance on the sum of the probabilities of an action
+                     ):
+    """
+    Read a transition table, one (state, action, next_state, probability, weight) row per transition,
+    in chunks, and build its compiled arrays directly (see "MDP.from_compiled"), without NetworkX;
+    States are numbered in order of first appearance, actions keep the order of their first transition;
+    Every transition keeps its own weight (see "MDP.get_weight" with a next_state);
+    Raise ValueError when the probabilities of a (state, action) do not sum to 1
+    """
+    if file_format is None:
+        file_format = 'parquet' if path.endswith(('.parquet', '.pq')) else 'csv'
+    if file_format == 'csv':
+        chunks = _csv_chunks(path, columns, chunk_size, delimiter)
+    elif file_format == 'parquet':
+        chunks = _parquet_chunks(path, columns, chunk_size)
+    else:
+        raise ValueError("unknown file format: {}".format(file_format))
+
+    states = _Labels(state_type)
+    actions = _Labels()
+    rows = {}  # (state id, action id) -> row id
+    row_keys = []
+    trans_row, succ, proba, weight = [], [], [], []
+    for state, action, next_state, probability, cost in chunks:
+        state_ids = states.encode(state)
+        next_ids = states.encode(next_state)
+        action_ids = actions.encode(action)
+        keys, inverse = np.unique(state_ids * (1 << 32) + action_ids, return_inverse=True)
+        row_ids = np.empty(len(keys), dtype=np.int64)
+        for k, key in enumerate(keys.tolist()):
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = len(row_keys)
+                row_keys.append(key)
+            row_ids[k] = row
+        trans_row.append(row_ids[inverse])
+        succ.append(next_ids)
+        proba.append(np.asarray(probability, dtype=float))
+        weight.append(np.asarray(cost, dtype=float))
+
+    trans_row = np.concatenate(trans_row) if trans_row else np.zeros(0, dtype=np.int64)
+    succ = np.concatenate(succ) if succ else np.zeros(0, dtype=np.int64)
+    proba = np.concatenate(proba) if proba else np.zeros(0)
+    weight = np.concatenate(weight) if weight else np.zeros(0)
+    row_keys = np.array(row_keys, dtype=np.int64)
+    row_state, row_action = row_keys >> 32, row_keys & ((1 << 32) - 1)
+
+    sums = np.bincount(trans_row, weights=proba, minlength=len(row_keys))
+    wrong = np.flatnonzero(np.abs(sums - 1.) > tol)
+    if len(wrong):
+        examples = [(states.labels[row_state[r]], actions.labels[row_action[r]], float(sums[r])) for r in wrong[:5]]
+        raise ValueError("probabilities not summing to 1 for {} (state, action) pairs, e.g. {}".format(
+            len(wrong), examples))
+
+    # rows grouped by state (in order of first transition), transitions by row (in file order)
+    row_order = np.lexsort((np.arange(len(row_keys)), row_state))
+    new_row = np.empty(len(row_keys), dtype=np.int64)
+    new_row[row_order] = np.arange(len(row_keys))
+    trans_order = np.argsort(new_row[trans_row], kind='stable')
+    n_states = len(states.labels)
+    action_ptr = np.zeros(n_states + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_state, minlength=n_states), out=action_ptr[1:])
+    succ_ptr = np.zeros(len(row_keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_row[trans_row], minlength=len(row_keys)), out=succ_ptr[1:])
+    compiled = CompiledMDP(states.labels, action_ptr, [actions.labels[a] for a in row_action[row_order].tolist()],
+                           succ_ptr, succ[trans_order], proba[trans_order], weight[trans_order])
+    return MDP.from_compiled(compiled)
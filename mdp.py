@@ -3,14 +3,65 @@
 #
 # -----------------------------------------------------------
 
+from array import array
+from collections import deque
+from fractions import Fraction
+import hashlib
+import math
+import pickle
 import networkx as nx
-import sys
-
-sys.setrecursionlimit(5000)
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
 
 BOT = ('BOT', float('inf'))
 
 
+class _TrackedMultiDiGraph(nx.MultiDiGraph):
+    """
+    MultiDiGraph counting its structural changes (nodes and edges added or removed),
+    so that the indexes derived from it can tell when they are stale
+    """
+
+    version = 0
+
+    def _touch(self):
+        self.version += 1
+
+    def add_node(self, node_for_adding, **attr):
+        super().add_node(node_for_adding, **attr)
+        self._touch()
+
+    def add_nodes_from(self, nodes_for_adding, **attr):
+        super().add_nodes_from(nodes_for_adding, **attr)
+        self._touch()
+
+    def remove_node(self, n):
+        super().remove_node(n)
+        self._touch()
+
+    def remove_nodes_from(self, nodes):
+        super().remove_nodes_from(nodes)
+        self._touch()
+
+    def add_edge(self, u_for_edge, v_for_edge, key=None, **attr):
+        key = super().add_edge(u_for_edge, v_for_edge, key=key, **attr)
+        self._touch()
+        return key
+
+    def remove_edge(self, u, v, key=None):
+        super().remove_edge(u, v, key=key)
+        self._touch()
+
+    def clear(self):
+        super().clear()
+        self._touch()
+
+    def clear_edges(self):
+        super().clear_edges()
+        self._touch()
+
+
 class MDP:
     """
     Implementation of Markov Decision Process structure
@@ -19,15 +70,85 @@ class MDP:
     States are stored in nodes;
     Actions are stored edges' keys;
     Weights of the actions and transition probabilities are stored in the attributes of the edges;
+    The action index, the weight index and the compiled form are built lazily and rebuilt
+      whenever nodes or edges are added or removed (call "invalidate" after editing edge attributes);
+    An MDP made by "from_compiled" only builds its graph when something needs it
     """
 
     def __init__(self):
-        self._g = nx.MultiDiGraph()
+        self._graph = _TrackedMultiDiGraph()
+        # CompiledMDP backing an MDP made by "from_compiled" (kept apart from the derived indexes in "_cache")
+        self._source = None
+        self._cache = {}
+        self._cache_version = -1
+
+    @classmethod
+    def from_compiled(cls, compiled):
+        """
+        MDP backed by the arrays of a CompiledMDP: "compile" returns "compiled" itself, states, actions and
+        distances are read from the arrays, and the NetworkX graph is only materialized on demand
+        """
+        mdp = cls()
+        mdp._load_compiled(compiled)
+        return mdp
+
+    def _load_compiled(self, compiled):
+        self._graph = None
+        self._source = compiled
+        self._cache = {}
+        self._cache_version = 0
+
+    @property
+    def _g(self):
+        if self._graph is None:
+            graph = _TrackedMultiDiGraph()
+            compiled = self.compile()
+            actions, _ = self._cached('indexes', self._build_indexes)
+            graph.add_nodes_from(compiled.states)
+            states, weight = compiled.states, compiled.weight.tolist()
+            succ_ptr, succ = compiled.succ_ptr.tolist(), compiled.succ.tolist()
+            for r, (i, action) in enumerate(zip(compiled.row_state.tolist(), compiled.actions)):
+                state = states[i]
+                for j in range(succ_ptr[r], succ_ptr[r + 1]):
+                    next_state = states[succ[j]]
+                    if graph.has_edge(state, next_state, action):
+                        continue  # repeated successor: one edge with the summed probability
+                    # every transition keeps its own weight (e.g. per-successor travel times)
+                    graph.add_edge(state, next_state, key=action,
+                                   action=action,
+                                   weight=weight[j],
+                                   length=-weight[j],
+                                   fr=state,
+                                   to=next_state,
+                                   proba=actions[state][action][next_state],
+                                   )
+            # the cached indexes and the source arrays describe this graph
+            graph.version = 0
+            self._graph = graph
+            self._cache.setdefault('compiled', compiled)
+        return self._graph
+
+    def _cached(self, name, build):
+        version = self._graph.version if self._graph is not None else 0
+        if self._cache_version != version:
+            self._cache = {}
+            self._cache_version = version
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def invalidate(self):
+        """
+        Drop the lazily built indexes (needed only after editing edge attributes in place)
+        """
+        self._cache = {}
 
     def get_graph(self):
         return self._g
 
     def get_states(self):
+        if self._graph is None:
+            return list(self.compile().states)
         return list(self._g.nodes())
 
     def get_info(self, state=None):
@@ -37,22 +158,48 @@ class MDP:
             _, _, d = list(zip(*(self._g.edges(state, keys=False, data=True))))
         return d
 
-    def get_actions(self, state):
+    def _build_indexes(self):
+        if self._graph is None:
+            return _indexes_of(self.compile())
         actions = {}
-        if state is not None:
-            d = self.get_info(state)
-            for item in d:
-                if item['action'] in actions.keys():
-                    actions[item['action']].update({item['to']: item['proba']})
+        weights = {}
+        for state in self._g.nodes():
+            actions[state] = {}
+            for _, _, item in self._g.edges(state, keys=False, data=True):
+                if item['action'] in actions[state]:
+                    actions[state][item['action']][item['to']] = item['proba']
                 else:
-                    actions[item['action']] = {item['to']: item['proba']}
-        return actions
+                    actions[state][item['action']] = {item['to']: item['proba']}
+                    # since all successors with same action share the same weight,
+                    # keep the first one
+                    weights[(state, item['action'])] = item.get('weight', float('nan'))
+        return actions, weights
+
+    def get_actions(self, state):
+        """
+        Return {action: {next_state: probability}} of "state";
+        The dict is shared with the index and must not be modified
+        """
+        if state is None:
+            return {}
+        actions, _ = self._cached('indexes', self._build_indexes)
+        return actions.get(state, {})
 
     def get_weight(self, state, action, next_state=None):
         if next_state is None:
-            # since all successors with same action share the same weight,
-            # choose the first one
-            next_state = list(self.get_actions(state)[action])[0]
+            _, weights = self._cached('indexes', self._build_indexes)
+            return weights[(state, action)]
+        if self._graph is None:
+            # read from the arrays: the first transition of the action to "next_state"
+            compiled = self.compile()
+            i, k = compiled.index.get(state), compiled.index.get(next_state)
+            if i is not None and k is not None:
+                for r in range(compiled.action_ptr[i], compiled.action_ptr[i + 1]):
+                    if compiled.actions[r] == action:
+                        for j in range(compiled.succ_ptr[r], compiled.succ_ptr[r + 1]):
+                            if compiled.succ[j] == k:
+                                return float(compiled.weight[j])
+            return float('nan')
         if self._g.has_edge(state, next_state, action):
             return self._g[state][next_state][action]['weight']
         else:
@@ -83,66 +230,576 @@ class MDP:
         else:
             return -1
 
+    def distance_to(self, targets):
+        """
+        Shortest "length" from every state to the closest state of "targets",
+        computed by a single Dijkstra search from all targets on the reversed graph;
+        Return an array indexed like the compiled MDP (inf for states that cannot reach "targets")
+        """
+        if self._graph is None:
+            return _distance_of(self.compile(), targets)
+        distance = np.full(self.compile().n_states, np.inf)
+        sources = [t for t in targets if self._g.has_node(t)]
+        if sources:
+            lengths = nx.multi_source_dijkstra_path_length(self._g.reverse(copy=False), sources, weight='length')
+            index = self.compile().index
+            for state, d in lengths.items():
+                distance[index[state]] = d
+        return distance
+
+    def fingerprint(self):
+        """
+        Hex digest of the compiled MDP (arrays and labels): equal for MDPs with the same states, actions
+        and transitions in the same order; cached until the graph changes
+        """
+        return self._cached('fingerprint', lambda: _fingerprint_of(self.compile()))
+
+    def compile(self):
+        """
+        Freeze the MDP into an integer-indexed CompiledMDP;
+        States keep the order of the graph nodes, actions the order of their first out-edge
+        and successors the order of the edges (the same order as "get_actions");
+        The result is cached until the graph changes (an MDP made by "from_compiled" returns its arrays
+        until its graph is materialized)
+        """
+        if self._graph is None and self._source is not None:
+            return self._source
+        return self._cached('compiled', self._compile)
+
+    def _compile(self):
+        states = list(self._g.nodes())
+        index = {state: i for i, state in enumerate(states)}
+        action_ptr = [0]
+        actions = []
+        succ_ptr = [0]
+        succ = []
+        proba = []
+        weight = []
+        for state in states:
+            rows = {}
+            for _, _, d in self._g.edges(state, keys=False, data=True):
+                rows.setdefault(d['action'], []).append(d)
+            for action in rows:
+                actions.append(action)
+                for d in rows[action]:
+                    succ.append(index[d['to']])
+                    proba.append(d['proba'])
+                    weight.append(d.get('weight', 0.))
+                succ_ptr.append(len(succ))
+            action_ptr.append(len(actions))
+        return CompiledMDP(states, action_ptr, actions, succ_ptr, succ, proba, weight)
+
+
+def weight_scale(mdp):
+    """
+    Greatest common divisor of the weights of "mdp" (exact for decimal weights; 1 when all weights are 0)
+    """
+    values = np.unique(mdp.compile().weight)
+    weights = {Fraction(str(w)) for w in values.tolist() if w != 0}
+    if not weights:
+        return 1
+    denominator = math.lcm(*(w.denominator for w in weights))
+    scale = Fraction(math.gcd(*(int(w * denominator) for w in weights)), denominator)
+    return int(scale) if scale.denominator == 1 else float(scale)
+
+
+def normalize_weights(mdp, resolution=None, rounding='pessimistic'):
+    """
+    Return (normalized MDP with integer weights, scale) where every weight w becomes w / scale;
+    Without "resolution", scale is the GCD of the weights and the rescaling is exact;
+    With "resolution", scale = resolution and the weights are bucketed: rounded down ('pessimistic',
+      accumulated values never exceed the true ones) or up ('optimistic', never below the true ones);
+    The normalized MDP is built from the compiled arrays of "mdp" (see "MDP.from_compiled")
+    """
+    if resolution is None:
+        scale = weight_scale(mdp)
+        bucket = lambda w: int(Fraction(str(w)) / Fraction(str(scale)))
+    elif rounding == 'pessimistic':
+        scale = resolution
+        bucket = lambda w: math.floor(Fraction(str(w)) / Fraction(str(resolution)))
+    elif rounding == 'optimistic':
+        scale = resolution
+        bucket = lambda w: math.ceil(Fraction(str(w)) / Fraction(str(resolution)))
+    else:
+        raise ValueError("unknown rounding: {}".format(rounding))
+    compiled = mdp.compile()
+    # exact rational bucketing of every distinct weight, then mapped back to the transitions
+    values, inverse = np.unique(compiled.weight, return_inverse=True)
+    weight = np.array([bucket(w) for w in values.tolist()], dtype=float)[inverse]
+    normalized = CompiledMDP(compiled.states, compiled.action_ptr, compiled.actions, compiled.succ_ptr,
+                             compiled.succ, compiled.proba, weight,
+                             row_state=compiled.row_state, trans_row=compiled.trans_row)
+    return MDP.from_compiled(normalized), scale
+
+
+def _indexes_of(compiled):
+    """
+    Action index {state: {action: {next_state: probability}}} and weight index {(state, action): weight}
+    of a CompiledMDP (the probabilities of repeated successors of an action are summed; the weight of an
+    action is that of its first transition, the weights of its successors being read from the arrays);
+    Values are Python floats, as in the indexes of a graph
+    """
+    action_ptr, succ_ptr, succ = compiled.action_ptr.tolist(), compiled.succ_ptr.tolist(), compiled.succ.tolist()
+    proba, weight = compiled.proba.tolist(), compiled.weight.tolist()
+    actions = {}
+    weights = {}
+    for i, state in enumerate(compiled.states):
+        actions[state] = {}
+        for r in range(action_ptr[i], action_ptr[i + 1]):
+            successors = actions[state].setdefault(compiled.actions[r], {})
+            for j in range(succ_ptr[r], succ_ptr[r + 1]):
+                # several successors of the same action can be the same state (e.g. BOT in an unfolded MDP)
+                next_state = compiled.states[succ[j]]
+                successors[next_state] = successors.get(next_state, 0.) + proba[j]
+            weights.setdefault((state, compiled.actions[r]), weight[succ_ptr[r]])
+    return actions, weights
+
+
+def _distance_of(compiled, targets):
+    """
+    "MDP.distance_to" computed on the arrays of a CompiledMDP: Dijkstra search from the targets on the
+    reversed transitions, of length -weight (the shortest of parallel transitions is kept)
+    """
+    targets = [compiled.index[t] for t in targets if t in compiled.index]
+    distance = np.full(compiled.n_states, np.inf)
+    if not targets:
+        return distance
+    src, dst, length = compiled.succ, compiled.row_state[compiled.trans_row], -compiled.weight
+    order = np.lexsort((length, dst, src))
+    src, dst, length = src[order], dst[order], length[order]
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    # explicit zeros of a sparse matrix are edges for scipy.sparse.csgraph
+    reverse = sp.csr_matrix((length[first], (src[first], dst[first])), shape=(compiled.n_states, compiled.n_states))
+    return dijkstra(reverse, directed=True, indices=targets, min_only=True)
+
+
+def _fingerprint_of(compiled):
+    digest = hashlib.blake2b(digest_size=20)
+    for name in ('action_ptr', 'succ_ptr', 'succ', 'proba', 'weight'):
+        digest.update(np.ascontiguousarray(getattr(compiled, name)).tobytes())
+    digest.update(pickle.dumps((compiled.states, compiled.actions), protocol=4))
+    return digest.hexdigest()
+
+
+def _int64(values):
+    """
+    int64 numpy array of a numpy array (without copy, e.g. memory-mapped) or of a growable array('q') buffer (copied,
+    so that the buffer can still grow)
+    """
+    return np.asarray(values, dtype=np.int64) if isinstance(values, np.ndarray) else np.array(values, dtype=np.int64)
+
+
+def gather_segments(ptr, idx):
+    """
+    Concatenate the index ranges ptr[i]:ptr[i+1] of every i in "idx"
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    starts = ptr[idx]
+    lens = ptr[idx + 1] - starts
+    return np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+
+
+class CompiledMDP:
+    """
+    Array-backed snapshot of an MDP in CSR layout;
+    States are numbered 0..n-1 ("states" maps index -> label, "index" maps label -> index);
+    The action rows of state i are action_ptr[i]:action_ptr[i+1] ("actions" holds their labels);
+    The transitions of action row r are succ_ptr[r]:succ_ptr[r+1], stored in "succ", "proba" and "weight";
+    """
+
+    def __init__(self, states, action_ptr, actions, succ_ptr, succ, proba, weight, row_state=None, trans_row=None):
+        self.states = list(states)
+        self.index = {state: i for i, state in enumerate(self.states)}
+        self.actions = list(actions)
+        self.action_ptr = np.asarray(action_ptr, dtype=np.int64)
+        self.succ_ptr = np.asarray(succ_ptr, dtype=np.int64)
+        self.succ = np.asarray(succ, dtype=np.int64)
+        self.proba = np.asarray(proba, dtype=float)
+        self.weight = np.asarray(weight, dtype=float)
+        # owner state of every action row and owner row of every transition (unless given, e.g. memory-mapped)
+        self.row_state = (np.repeat(np.arange(self.n_states), np.diff(self.action_ptr)) if row_state is None
+                          else np.asarray(row_state, dtype=np.int64))
+        self.trans_row = (np.repeat(np.arange(self.n_rows), np.diff(self.succ_ptr)) if trans_row is None
+                          else np.asarray(trans_row, dtype=np.int64))
+
+    def compile(self):
+        """
+        Already compiled: lets a CompiledMDP stand in for the MDP it was built from
+        """
+        return self
+
+    @property
+    def n_states(self):
+        return len(self.states)
+
+    @property
+    def n_rows(self):
+        return len(self.actions)
+
+    @property
+    def n_transitions(self):
+        return len(self.succ)
+
+    def predecessors(self):
+        """
+        Reverse adjacency in CSR layout: the transitions entering state i are
+        pred_trans[pred_ptr[i]:pred_ptr[i+1]]; built once and cached
+        """
+        if not hasattr(self, '_predecessors'):
+            pred_ptr = np.zeros(self.n_states + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.succ, minlength=self.n_states), out=pred_ptr[1:])
+            self._predecessors = pred_ptr, np.argsort(self.succ, kind='stable')
+        return self._predecessors
+
+    def sample(self, rows, rng):
+        """
+        Draw one transition of every action row of "rows" with the random generator "rng",
+        by inverting the cumulative probabilities (cached) of the transitions
+        """
+        if not hasattr(self, '_cumulative'):
+            cumulative = np.concatenate(([0.], np.cumsum(self.proba)))
+            self._cumulative = cumulative[1:], cumulative[self.succ_ptr[:-1]], np.diff(cumulative[self.succ_ptr])
+        cumulative, row_start, row_total = self._cumulative
+        draw = row_start[rows] + rng.random(len(rows)) * row_total[rows]
+        transition = np.searchsorted(cumulative, draw, side='right')
+        return np.clip(transition, self.succ_ptr[rows], self.succ_ptr[rows + 1] - 1)
+
+    def policy_rows(self, policy):
+        """
+        Action rows of a policy {state: action} or {(state, value): action} in compiled order (BOT and the
+        None actions skipped); Return (states, values, rows) arrays, values being None for a stationary policy;
+        Raise ValueError when an action is not available in its state
+        """
+        rows_of = {(self.row_state[row], action): row for row, action in enumerate(self.actions)}
+        stationary = all(key in self.index for key in policy)
+        states, values, rows = [], [], []
+        for key, action in policy.items():
+            if key == BOT or action is None:
+                continue
+            state, value = (key, 0) if stationary else key
+            i = self.index[state]
+            row = rows_of.get((i, action))
+            if row is None:
+                raise ValueError("action {} is not available in state {}".format(action, state))
+            states.append(i)
+            values.append(value)
+            rows.append(row)
+        return np.array(states, dtype=np.int64), (None if stationary else values), np.array(rows, dtype=np.int64)
+
+    def row_sum(self, values):
+        """
+        Sum a per-transition array over every action row
+        """
+        if self.n_rows == 0:
+            return np.zeros(0)
+        return np.add.reduceat(values, self.succ_ptr[:-1])
+
+    def expectation(self, x):
+        """
+        Expected value of the per-state array "x" after taking each action row
+        """
+        return self.row_sum(self.proba * x[self.succ])
+
+    def backup(self, states, x):
+        """
+        max_a sum_ns p(s, a, ns) * x[ns] for every state s of the index array "states"
+        (which must all have at least one action)
+        """
+        rows = gather_segments(self.action_ptr, states)
+        transitions = gather_segments(self.succ_ptr, rows)
+        row_starts = np.cumsum(np.diff(self.succ_ptr)[rows]) - np.diff(self.succ_ptr)[rows]
+        state_starts = np.cumsum(np.diff(self.action_ptr)[states]) - np.diff(self.action_ptr)[states]
+        q = np.add.reduceat(self.proba[transitions] * x[self.succ[transitions]], row_starts)
+        return np.maximum.reduceat(q, state_starts)
+
+    def state_max(self, q, empty=-np.inf):
+        """
+        Maximum of the per-row array "q" over the actions of every state;
+        States without actions get "empty"
+        """
+        out = np.full(self.n_states, empty, dtype=float)
+        has_actions = np.diff(self.action_ptr) > 0
+        if has_actions.any():
+            out[has_actions] = np.maximum.reduceat(q, self.action_ptr[:-1][has_actions])
+        return out
+
+    def state_argmax(self, q):
+        """
+        Row index of the first maximising action of every state (-1 for states without actions)
+        """
+        best = self.state_max(q)
+        candidates = np.where(q >= best[self.row_state], np.arange(self.n_rows), self.n_rows)
+        out = np.full(self.n_states, -1, dtype=np.int64)
+        has_actions = np.diff(self.action_ptr) > 0
+        if has_actions.any():
+            out[has_actions] = np.minimum.reduceat(candidates, self.action_ptr[:-1][has_actions])
+        return out
+
+    def to_array(self, values, default=0.):
+        """
+        Convert a {state: value} dict into a per-state array
+        """
+        x = np.full(self.n_states, default, dtype=float)
+        for state, value in values.items():
+            x[self.index[state]] = value
+        return x
+
+    def to_dict(self, x):
+        """
+        Convert a per-state array into a {state: value} dict
+        """
+        return dict(zip(self.states, np.asarray(x).tolist()))
+
 
 class UnfoldedMDP(MDP):
     """
-    Unfold an MDP following an initial state (s0), a list of target states (T) and a maximum length threshold (l)
-    """
-
-    def __init__(self, mdp, s0, target, length, init_value=0):
-        super().__init__()
-        self._target = []
-        mdp_graph = mdp.get_graph()
-        bot = BOT
-        self._g.add_node(bot)
-        self._g.add_edge(u_for_edge=bot, v_for_edge=bot,
-                         key='loop', action='loop', proba=1,
-                         fr=bot, to=bot)
-        all_pairs_length = dict(nx.all_pairs_dijkstra_path_length(mdp_graph, weight='length'))
-
-        def unfold(state, value):
-            if not self._g.has_node((state, value)):
-                self._g.add_node((state, value))
-                if state in target:
-                    for action in mdp_graph[state][state]:
-                        self._target.append((state, value))
-                        self._g.add_edge((state, value), (state, value),
-                                         key=action,
-                                         action=action,
-                                         fr=(state, value),
-                                         to=(state, value),
-                                         proba=mdp_graph[state][state][action]['proba'],
-                                         )
-                else:
-                    for next_state in mdp_graph[state]:
-                        for action in mdp_graph[state][next_state]:
-                            next_value = value + mdp_graph[state][next_state][action]['weight']
-                            remaining = float('inf')
-                            shortest_length = float('inf')
-                            for t in target:
-                                if t in all_pairs_length[next_state]:
-                                    shortest_length = all_pairs_length[next_state][t]
-                                if shortest_length < remaining:
-                                    remaining = shortest_length
-                            if next_value - remaining >= length:
-                                unfold(next_state, next_value)
-                                self._g.add_edge((state, value), (next_state, next_value),
-                                                 key=action,
-                                                 action=action,
-                                                 fr=(state, value),
-                                                 to=(next_state, next_value),
-                                                 proba=mdp_graph[state][next_state][action]['proba'],
-                                                 )
-                            else:
-                                self._g.add_edge((state, value), bot,
-                                                 key='loop',
-                                                 action='loop',
-                                                 fr=(state, value),
-                                                 to=bot,
-                                                 proba=mdp_graph[state][next_state][action]['proba'],
-                                                 )
-
-        unfold(s0, init_value)
+    Unfold an MDP following an initial state (s0), a list of target states (T) and a maximum length threshold (l);
+    Unfolded (state, value) nodes are dense integers (node 0 is BOT), keyed by
+      value layer * number of base states + base state index;
+    Every unfolded edge is a pair (base transition index, destination node) referring to the compiled base MDP;
+    (state, value) labels are only rebuilt by "compile" and the other output methods, and the NetworkX graph
+      returned by "get_graph" is a read-only copy built on demand;
+    The edges cut by the threshold point to BOT, so that "extend" can relax the threshold later;
+    "mdp" may be a CompiledMDP when the pruning "distance" array (see "distance_to") is given, and the other
+      initial states "sources" are unfolded from the same init_value, sharing their common (state, value) nodes
+    """
+
+    def __init__(self, mdp, s0, target, length, init_value=0, distance=None, sources=()):
+        self._cache = {}
+        self._cache_version = -1
+        self._version = 0
+        # the arrays are the source of truth: the graph is materialized by "get_graph"
+        self._graph = None
+        self._source = None
+        self._base = mdp.compile()
+        self._n_base = self._base.n_states
+        self._base_lists = self._lists_of(self._base)
+        self._distance = (mdp.distance_to(target) if distance is None else np.asarray(distance)).tolist()
+        target_set = set(target)
+        self._is_target = [state in target_set for state in self._base.states]
+        self._length = length
+        self._codes = {}
+        self._layers = {}
+        self._layer_values = []
+        self._node_state = array('q', [-1])
+        self._node_layer = array('q', [-1])
+        self._target = array('q')
+        # BOT loops on itself (base transition -1)
+        self._edge_ptr = array('q', [0, 1])
+        self._edge_trans = array('q', [-1])
+        self._edge_dst = array('q', [0])
+
+        # worklist of unfolded nodes whose out-edges are not built yet;
+        # nodes are expanded in the order they are discovered (their id order), without recursion
+        self._worklist = deque()
+        for state in [s0] + list(sources):
+            self._discover(self._base.index[state], init_value)
+        self._unfold()
+
+    @staticmethod
+    def _lists_of(base):
+        return (base.action_ptr.tolist(), base.succ_ptr.tolist(), base.succ.tolist(), base.proba.tolist(),
+                # keep integral weights as integers in the (state, value) labels
+                [int(w) if w.is_integer() else w for w in base.weight.tolist()])
+
+    def to_arrays(self):
+        """
+        Return the unfolding as {name: numpy array} plus its "base" CompiledMDP, threshold "length"
+        and "layer_values", the arguments of "from_arrays"
+        """
+        arrays = {name: np.array(getattr(self, '_' + name), dtype=np.int64)
+                  for name in ('node_state', 'node_layer', 'target', 'edge_ptr', 'edge_trans', 'edge_dst')}
+        arrays.update(base=self._base, length=self._length, layer_values=list(self._layer_values),
+                      distance=np.asarray(self._distance, dtype=float),
+                      is_target=np.asarray(self._is_target, dtype=bool))
+        return arrays
+
+    @property
+    def nbytes(self):
+        """
+        Size of the node and edge buffers (8 bytes per entry)
+        """
+        return 8 * (2 * len(self._node_state) + len(self._target) + len(self._edge_ptr) + 2 * len(self._edge_trans))
+
+    @classmethod
+    def from_arrays(cls, base, length, layer_values, distance, is_target,
+                    node_state, node_layer, target, edge_ptr, edge_trans, edge_dst):
+        """
+        UnfoldedMDP over the arrays of "to_arrays" (e.g. memory-mapped), used as they are;
+        The growable buffers are only rebuilt when the unfolding is extended
+        """
+        unfolded = cls.__new__(cls)
+        unfolded._cache = {}
+        unfolded._cache_version = -1
+        unfolded._version = 0
+        unfolded._graph = None
+        unfolded._source = None
+        unfolded._base = base
+        unfolded._n_base = base.n_states
+        unfolded._length = length
+        unfolded._layer_values = list(layer_values)
+        unfolded._distance, unfolded._is_target = distance, is_target
+        unfolded._node_state, unfolded._node_layer, unfolded._target = node_state, node_layer, target
+        unfolded._edge_ptr, unfolded._edge_trans, unfolded._edge_dst = edge_ptr, edge_trans, edge_dst
+        unfolded._worklist = deque()
+        return unfolded
+
+    def _thaw(self):
+        """
+        Turn the arrays of "from_arrays" back into growable buffers and rebuild the (state, value) index
+        """
+        if not isinstance(self._edge_ptr, np.ndarray):
+            return
+        self._base_lists = self._lists_of(self._base)
+        self._distance = np.asarray(self._distance).tolist()
+        self._is_target = np.asarray(self._is_target).tolist()
+        for name in ('node_state', 'node_layer', 'target', 'edge_ptr', 'edge_trans', 'edge_dst'):
+            setattr(self, '_' + name, array('q', np.asarray(getattr(self, '_' + name), dtype=np.int64).tobytes()))
+        self._layers = {value: layer for layer, value in enumerate(self._layer_values)}
+        codes = np.asarray(self._node_layer, dtype=np.int64)[1:] * self._n_base + np.asarray(self._node_state)[1:]
+        self._codes = dict(zip(codes.tolist(), range(1, len(self._node_state))))
+
+    @property
+    def _g(self):
+        return self.get_graph()
+
+    def _cached(self, name, build):
+        if self._cache_version != self._version:
+            self._cache = {}
+            self._cache_version = self._version
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def _discover(self, state, value):
+        layer = self._layers.get(value)
+        if layer is None:
+            layer = self._layers[value] = len(self._layer_values)
+            self._layer_values.append(value)
+        code = layer * self._n_base + state
+        node = self._codes.get(code)
+        if node is None:
+            node = self._codes[code] = len(self._node_state)
+            self._node_state.append(state)
+            self._node_layer.append(layer)
+            self._worklist.append(node)
+        return node
+
+    def _unfold(self):
+        action_ptr, succ_ptr, succ, _, weight = self._base_lists
+        distance = self._distance
+        while self._worklist:
+            node = self._worklist.popleft()
+            state = self._node_state[node]
+            value = self._layer_values[self._node_layer[node]]
+            transitions = range(succ_ptr[action_ptr[state]], succ_ptr[action_ptr[state + 1]])
+            if self._is_target[state]:
+                self._target.append(node)
+                for j in transitions:
+                    if succ[j] == state:
+                        self._edge_trans.append(j)
+                        self._edge_dst.append(node)
+            else:
+                for j in transitions:
+                    next_value = value + weight[j]
+                    # the best remaining length from the successor to the target set must fit in the threshold
+                    if next_value - distance[succ[j]] >= self._length:
+                        self._edge_dst.append(self._discover(succ[j], next_value))
+                    else:
+                        self._edge_dst.append(0)
+                    self._edge_trans.append(j)
+            self._edge_ptr.append(len(self._edge_trans))
+        self._version += 1
+
+    def extend(self, length):
+        """
+        Relax the threshold to a looser "length": only the edges previously cut to BOT
+        are re-examined and the newly reachable nodes are unfolded;
+        Return the list of the (state, value) nodes whose out-edges changed, plus the new nodes
+        """
+        if length > self._length:
+            raise ValueError("an unfolded MDP can only be extended to a looser threshold")
+        self._thaw()
+        self._length = length
+        dst = np.array(self._edge_dst, dtype=np.int64)
+        cut = np.flatnonzero(dst == 0)[1:]
+        trans = np.array(self._edge_trans, dtype=np.int64)[cut]
+        owner = np.repeat(np.arange(len(self._node_state)), np.diff(self._edge_ptr))[cut]
+        values = np.array(self._layer_values + [0])[np.array(self._node_layer, dtype=np.int64)[owner]]
+        next_values = values + self._base.weight[trans]
+        keep = next_values - np.array(self._distance)[self._base.succ[trans]] >= length
+        weight = self._base_lists[4]
+        changed = set()
+        for position, j, node in zip(cut[keep].tolist(), trans[keep].tolist(), owner[keep].tolist()):
+            value = self._layer_values[self._node_layer[node]]
+            self._edge_dst[position] = self._discover(self._base_lists[2][j], value + weight[j])
+            changed.add(node)
+        changed.update(self._worklist)
+        self._unfold()
+        states = self.compile().states
+        return [states[node] for node in sorted(changed)]
+
+    def _label(self, node):
+        if node == 0:
+            return BOT
+        return self._base.states[self._node_state[node]], self._layer_values[self._node_layer[node]]
+
+    def _compile(self):
+        base = self._base
+        trans = _int64(self._edge_trans)
+        edge_node = np.repeat(np.arange(len(self._node_state)), np.diff(self._edge_ptr))
+        base_row = np.where(trans >= 0, base.trans_row[trans], -1)
+        # a new action row starts with every node and every base row
+        starts = np.ones(len(trans), dtype=bool)
+        starts[1:] = (edge_node[1:] != edge_node[:-1]) | (base_row[1:] != base_row[:-1])
+        starts = np.flatnonzero(starts)
+        action_ptr = np.zeros(len(self._node_state) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_node[starts], minlength=len(self._node_state)), out=action_ptr[1:])
+        return CompiledMDP([self._label(node) for node in range(len(self._node_state))],
+                           action_ptr,
+                           [base.actions[r] if r >= 0 else 'loop' for r in base_row[starts].tolist()],
+                           np.append(starts, len(trans)),
+                           _int64(self._edge_dst),
+                           np.where(trans >= 0, base.proba[trans], 1.),
+                           np.where(trans >= 0, base.weight[trans], 0.))
+
+    def _build_indexes(self):
+        return _indexes_of(self.compile())
+
+    def _materialize(self):
+        graph = _TrackedMultiDiGraph()
+        actions, weights = self._cached('indexes', self._build_indexes)
+        graph.add_nodes_from(actions)
+        for state in actions:
+            for action in actions[state]:
+                for next_state, proba in actions[state][action].items():
+                    graph.add_edge(state, next_state, key=action,
+                                   action=action,
+                                   weight=weights[(state, action)],
+                                   fr=state,
+                                   to=next_state,
+                                   proba=proba,
+                                   )
+        return graph
+
+    def get_graph(self):
+        return self._cached('graph', self._materialize)
+
+    def get_states(self):
+        return list(self.compile().states)
+
+    def get_weight(self, state, action, next_state=None):
+        _, weights = self._cached('indexes', self._build_indexes)
+        return weights.get((state, action), float('nan'))
 
     def get_target(self):
-        return self._target
+        states = self.compile().states
+        return [states[node] for node in self._target]
+
+    def get_layer_sizes(self):
+        """
+        Return {value: number of unfolded states generated with this accumulated value}
+        """
+        counts = np.bincount(np.array(self._node_layer, dtype=np.int64)[1:], minlength=len(self._layer_values))
+        return dict(zip(self._layer_values, counts.tolist()))
@@ -0,0 +1,122 @@
+# -----------------------------------------------------------
+# Vectorized simulation of policies on a compiled MDP:
+# N episodes are run in parallel as numpy arrays
+#
+# -----------------------------------------------------------
+
+from mdp import MDP
+import numpy as np
+
+
+class Simulation:
+    """
+    Outcome of "simulate" for every episode: "success" (a target was reached), "failure" (the policy had no
+    action for the current state or (state, value) node), "timeout" (max_steps reached),
+    "cost" (accumulated weight when the episode stopped) and "steps"
+    """
+
+    def __init__(self, success, failure, cost, steps):
+        self.success = success
+        self.failure = failure
+        self.timeout = ~(success | failure)
+        self.cost = cost
+        self.steps = steps
+
+    @property
+    def episodes(self):
+        return len(self.success)
+
+    @property
+    def success_rate(self):
+        return float(self.success.mean()) if self.episodes else 0.
+
+    @property
+    def timeout_rate(self):
+        return float(self.timeout.mean()) if self.episodes else 0.
+
+    def probability(self, length):
+        """
+        Fraction of the episodes reaching a target with an accumulated weight >= "length"
+        """
+        return float((self.success & (self.cost >= length)).mean()) if self.episodes else 0.
+
+    def histogram(self, bins=10):
+        """
+        Histogram (counts, bin edges) of the accumulated weights of the successful episodes
+        """
+        return np.histogram(self.cost[self.success], bins=bins)
+
+    def __repr__(self):
+        return "Simulation(episodes={}, success_rate={:.4f}, timeout_rate={:.4f})".format(
+            self.episodes, self.success_rate, self.timeout_rate)
+
+
+def simulate(mdp: MDP,
+             policy: dict,  # Dict. {state: action} or {(state, value): action} of "guaranteed_short_path"
+             initial_state: object,
+             targets: list,
+             episodes: int = 1000,  # Integer. Number of episodes run in parallel
+             max_steps: int = 100,  # Integer. Episodes still running after "max_steps" steps time out
+             init_value: float = 0,  # Float. Initial accumulated value of the (state, value) policies
+             seed: int = None  # Integer. Seed of the random generator
+             ):
+    """
+    Run "episodes" episodes of "policy" from "initial_state" until a state of "targets" is reached;
+    A policy whose keys are all states of "mdp" is stationary, otherwise its keys are (state, accumulated value)
+      nodes and the action depends on the weight accumulated so far;
+    Successors are drawn for all running episodes at once (see CompiledMDP.sample)
+    """
+    compiled = mdp.compile()
+    rng = np.random.default_rng(seed)
+    n = compiled.n_states
+    is_target = np.zeros(n, dtype=bool)
+    is_target[[compiled.index[t] for t in targets if t in compiled.index]] = True
+
+    policy_states, policy_values, policy_rows = compiled.policy_rows(policy)
+    if policy_values is None:
+        row_of_state = np.full(n, -1, dtype=np.int64)
+        row_of_state[policy_states] = policy_rows
+    else:
+        # (state, value) nodes are looked up by code = layer of the value * n + state in the sorted codes
+        layers = {}
+        for value in policy_values:
+            layers.setdefault(value, len(layers))
+        codes = np.array([layers[v] for v in policy_values], dtype=np.int64) * n + policy_states
+        order = np.argsort(codes)
+        codes, code_rows = codes[order], policy_rows[order]
+
+    state = np.full(episodes, compiled.index[initial_state], dtype=np.int64)
+    cost = np.full(episodes, init_value, dtype=float)
+    steps = np.zeros(episodes, dtype=np.int64)
+    success = is_target[state].copy()
+    failure = np.zeros(episodes, dtype=bool)
+    running = np.flatnonzero(~success)
+
+    for _ in range(max_steps):
+        if not len(running):
+            break
+        s = state[running]
+        if policy_values is None:
+            rows = row_of_state[s]
+        else:
+            values, inverse = np.unique(cost[running], return_inverse=True)
+            layer = np.array([layers.get(v, -1) for v in values.tolist()], dtype=np.int64)[inverse]
+            code = layer * n + s
+            if len(codes):
+                position = np.minimum(np.searchsorted(codes, code), len(codes) - 1)
+                rows = np.where((layer >= 0) & (codes[position] == code), code_rows[position], -1)
+            else:
+                rows = np.full(len(running), -1, dtype=np.int64)
+        lost = rows < 0
+        failure[running[lost]] = True
+        running, rows = running[~lost], rows[~lost]
+
+        transition = compiled.sample(rows, rng)
+        state[running] = compiled.succ[transition]
+        cost[running] += compiled.weight[transition]
+        steps[running] += 1
+        reached = is_target[state[running]]
+        success[running[reached]] = True
+        running = running[~reached]
+
+    return Simulation(success, failure, cost, steps)
@@ -0,0 +1,80 @@
+# -----------------------------------------------------------
+# On-disk format of MDPs and unfolded MDPs: a directory of raw
+# .npy arrays (memory-mappable) plus a pickled label table
+#
+# -----------------------------------------------------------
+
+import json
+import os
+import pickle
+from mdp import MDP, UnfoldedMDP, CompiledMDP
+import numpy as np
+
+FORMAT = 'sspp-mdp'
+VERSION = 1
+
+COMPILED_ARRAYS = ('action_ptr', 'succ_ptr', 'succ', 'proba', 'weight', 'row_state', 'trans_row')
+UNFOLDED_ARRAYS = ('distance', 'is_target', 'node_state', 'node_layer', 'target', 'edge_ptr', 'edge_trans', 'edge_dst')
+
+
+def _save_compiled(compiled, path, prefix=''):
+    for name in COMPILED_ARRAYS:
+        np.save(os.path.join(path, prefix + name + '.npy'), getattr(compiled, name))
+    return {'states': compiled.states, 'actions': compiled.actions}
+
+
+def _load_compiled(path, labels, mmap_mode, prefix=''):
+    arrays = {name: np.load(os.path.join(path, prefix + name + '.npy'), mmap_mode=mmap_mode)
+              for name in COMPILED_ARRAYS}
+    return CompiledMDP(labels['states'], arrays['action_ptr'], labels['actions'], arrays['succ_ptr'],
+                       arrays['succ'], arrays['proba'], arrays['weight'],
+                       row_state=arrays['row_state'], trans_row=arrays['trans_row'])
+
+
+def save(mdp: MDP,
+         path: str  # String. Directory to write (created if needed)
+         ):
+    """
+    Write "mdp" to the directory "path": meta.json (format, version, kind), labels.pkl (state and action labels)
+    and one .npy file per array; an UnfoldedMDP is stored as its dense node/edge arrays and its compiled base MDP
+    """
+    os.makedirs(path, exist_ok=True)
+    if isinstance(mdp, UnfoldedMDP):
+        arrays = mdp.to_arrays()
+        labels = _save_compiled(arrays.pop('base'), path, 'base_')
+        labels.update(length=arrays.pop('length'), layer_values=arrays.pop('layer_values'))
+        for name in UNFOLDED_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), arrays[name])
+        kind = 'unfolded'
+    else:
+        labels = _save_compiled(mdp.compile(), path)
+        kind = 'mdp'
+    with open(os.path.join(path, 'labels.pkl'), 'wb') as f:
+        pickle.dump(labels, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # written last: a directory without meta.json is incomplete
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'format': FORMAT, 'version': VERSION, 'kind': kind}, f)
+
+
+def load(path: str,  # String. Directory written by "save"
+         mmap: bool = True  # Boolean. Memory-map the arrays (read-only, shared between processes) or read them
+         ):
+    """
+    Read an MDP (see "MDP.from_compiled") or an UnfoldedMDP (see "UnfoldedMDP.from_arrays") written by "save";
+    With "mmap", the arrays are opened with np.load(mmap_mode='r'): nothing is copied, the pages are loaded on
+      demand and shared by all the processes opening the same files
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT:
+        raise ValueError("{} is not a saved MDP".format(path))
+    if meta.get('version') != VERSION:
+        raise ValueError("unsupported MDP format version {} (expected {})".format(meta.get('version'), VERSION))
+    with open(os.path.join(path, 'labels.pkl'), 'rb') as f:
+        labels = pickle.load(f)
+    mmap_mode = 'r' if mmap else None
+    if meta['kind'] == 'unfolded':
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in UNFOLDED_ARRAYS}
+        return UnfoldedMDP.from_arrays(_load_compiled(path, labels, mmap_mode, 'base_'),
+                                       labels['length'], labels['layer_values'], **arrays)
+    return MDP.from_compiled(_load_compiled(path, labels, mmap_mode))